@@ -0,0 +1,542 @@
+#! /usr/bin/env python3
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+''' Benchmark for btrfs-snapshots-diff.py
+
+Generates synthetic send streams (no Btrfs file system needed), then
+measures, for each stream size, time, throughput and peak memory of:
+BtrfsStream() initialisation, decode(), print_by_paths(), decoding
+without and with CRC32C verification (verify=True), CSV and JSON
+output. Each size runs in its own process, so that peak memory (max RSS)
+is measured per size; it grows from phase to phase, as decoded commands
+are kept for the by-path output.
+The by-path report is also timed on a single path with many actions
+(--actions).
+
+Streams are made of files created under temporary names then renamed
+(like btrfs send does for new inodes), modified, renamed (possibly
+through temporary names), linked and deleted; --mix sets the weight of
+each operation, --depth the depth of paths.
+--proto 2 writes a v2 stream (data attributes without length), that can
+also have encoded_write (compressed data, like "btrfs send --proto 2
+--compressed-data") and fallocate commands, e.g.:
+./benchmark.py --proto 2 --mix encoded_write=4,update_extent=0 --data-size 65536
+
+Use --script to benchmark another version of btrfs-snapshots-diff.py,
+e.g. to compare before / after a change:
+
+git show HEAD~1:btrfs-snapshots-diff.py > /tmp/before.py
+./benchmark.py --sizes 10k,1M --script /tmp/before.py
+./benchmark.py --sizes 10k,1M
+
+Use --generate to only write a stream, e.g. to profile the script:
+./benchmark.py -n 1M --generate /tmp/stream
+'''
+
+import argparse
+import contextlib
+import importlib.util
+import inspect
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from functools import lru_cache
+from struct import Struct
+
+s_head = Struct('<IHI')
+s_tlv = Struct('<HH')
+s_u64 = Struct('<Q')
+s_timespec = Struct('<QL')
+
+# Command / attribute numbers, from btrfs/send.h
+C_SNAPSHOT, C_MKFILE, C_MKDIR, C_SYMLINK, C_RENAME, C_LINK = 2, 3, 4, 8, 9, 10
+C_UNLINK, C_SET_XATTR, C_WRITE, C_TRUNCATE, C_CHMOD, C_CHOWN = 11, 13, 15, 17, 18, 19
+C_UTIMES, C_END, C_UPDATE_EXTENT = 20, 21, 22
+C_FALLOCATE, C_ENCODED_WRITE = 23, 25
+A_UUID, A_CTRANSID, A_INO, A_SIZE, A_MODE, A_UID, A_GID = 1, 2, 3, 4, 5, 6, 7
+A_CTIME, A_MTIME, A_ATIME = 9, 10, 11
+A_XATTR_NAME, A_XATTR_DATA, A_PATH, A_PATH_TO, A_PATH_LINK = 13, 14, 15, 16, 17
+A_FILE_OFFSET, A_DATA, A_CLONE_UUID, A_CLONE_CTRANSID = 18, 19, 20, 21
+A_FALLOCATE_MODE, A_UNENCODED_FILE_LEN, A_UNENCODED_LEN = 25, 27, 28
+A_UNENCODED_OFFSET, A_COMPRESSION = 29, 30
+
+# Operations needing a v2 stream
+V2_OPERATIONS = ('encoded_write', 'fallocate')
+
+# Default weights of generated operations
+MIX = {
+    'create': 4,
+    'mkdir': 0.2,
+    'symlink': 0.2,
+    'rename': 0.5,
+    'link': 0.2,
+    'unlink': 0.3,
+    'update_extent': 4,
+    'write': 0,
+    'encoded_write': 0,
+    'fallocate': 0,
+    'truncate': 0.3,
+    'chown': 1,
+    'chmod': 1,
+    'utimes': 4,
+    'set_xattr': 0.3,
+}
+
+GENERATION = 2
+
+
+def tlv(attr, value):
+    ''' Encodes one attribute '''
+    return s_tlv.pack(attr, len(value)) + value
+
+
+def data_tlv(value, proto=1):
+    ''' Encodes a data attribute, the last one of its command: without
+    length since v2 '''
+    if proto >= 2:
+        return A_DATA.to_bytes(2, 'little') + value
+    return tlv(A_DATA, value)
+
+
+@lru_cache(maxsize=None)
+def crc_function():
+    ''' crc32c() of btrfs-snapshots-diff.py next to this script '''
+    script = os.path.join(os.path.dirname(__file__), 'btrfs-snapshots-diff.py')
+    return load(script).crc32c
+
+
+def command(cmd, *attrs):
+    ''' Encodes one command, with its CRC32C (computed with the CRC field
+    set to 0, as btrfs send does) '''
+    payload = b''.join(attrs)
+    crc32c = crc_function()
+    crc = crc32c(payload, crc32c(s_head.pack(len(payload), cmd, 0)))
+    return s_head.pack(len(payload), cmd, crc) + payload
+
+
+def parse_count(count):
+    ''' '10k' => 10000, '1M' => 1000000 '''
+    units = {'k': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9}
+    if count[-1:] in units:
+        return int(float(count[:-1]) * units[count[-1]])
+    return int(count)
+
+
+def parse_mix(mix):
+    ''' 'create=2,rename=1' => MIX with these weights '''
+    weights = dict(MIX)
+    for item in mix.split(',') if mix else ():
+        name, _, weight = item.partition('=')
+        if name not in weights:
+            raise argparse.ArgumentTypeError(f'unknown operation "{name}"')
+        weights[name] = float(weight)
+    return weights
+
+
+def generate(f_out, count, depth=3, mix=None, seed=0, data_size=4096, proto=1):
+    ''' Writes a send stream of version proto of about count commands, made
+    of operations randomly chosen according to mix weights, on paths of
+    depth levels. Returns the number of commands written '''
+    rng = random.Random(seed)
+    mix = MIX if mix is None else mix
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    u64 = s_u64.pack
+    now = tlv(A_ATIME, s_timespec.pack(1610578045, 111667600))
+    now += tlv(A_MTIME, s_timespec.pack(1610578045, 111667600))
+    now += tlv(A_CTIME, s_timespec.pack(1610578045, 111667600))
+    owner = tlv(A_UID, u64(1000)) + tlv(A_GID, u64(100))
+    data = data_tlv(bytes(data_size), proto)
+    # Compressed data does not compress further, like random bytes (as
+    # rng.randbytes(), which needs Python 3.9)
+    encoded = data_tlv(
+        rng.getrandbits(8 * data_size).to_bytes(data_size, 'little'), proto
+    )
+    # zstd, 4 times smaller than file data
+    encoding = (
+        tlv(A_UNENCODED_FILE_LEN, u64(4 * data_size))
+        + tlv(A_UNENCODED_LEN, u64(4 * data_size))
+        + tlv(A_UNENCODED_OFFSET, u64(0))
+        + tlv(A_COMPRESSION, (2).to_bytes(4, 'little'))
+    )
+
+    # Existing directories, 10 entries per level
+    dirs = [
+        '/'.join(f'd{(i // 10 ** level) % 10}' for level in range(depth - 2, -1, -1))
+        for i in range(10 ** (depth - 1))
+    ]
+    files = []
+    ino = 256
+    written = 0
+
+    def new_path(kind):
+        nonlocal ino
+        ino += 1
+        directory = dirs[ino % len(dirs)]
+        return ino, f'{directory}/{kind}{ino}' if directory else f'{kind}{ino}'
+
+    def orphan(ino):
+        return f'o{ino}-{GENERATION}-0'.encode()
+
+    f_out.write(b'btrfs-stream\0' + proto.to_bytes(4, 'little'))
+    f_out.write(
+        command(
+            C_SNAPSHOT,
+            tlv(A_PATH, b'child'),
+            tlv(A_UUID, bytes(range(16))),
+            tlv(A_CTRANSID, u64(GENERATION)),
+            tlv(A_CLONE_UUID, bytes(range(16, 32))),
+            tlv(A_CLONE_CTRANSID, u64(GENERATION - 1)),
+        )
+    )
+
+    while written < count:
+        for name in rng.choices(names, weights, k=1024):
+            if name not in ('create', 'mkdir', 'symlink') and not files:
+                name = 'create'
+
+            if name in ('create', 'mkdir', 'symlink'):
+                # New inodes are created under a temporary name, then renamed
+                ino, path = new_path(name[0])
+                tmp = orphan(ino)
+                if name == 'create':
+                    cmds = [command(C_MKFILE, tlv(A_PATH, tmp), tlv(A_INO, u64(ino)))]
+                    files.append(path)
+                elif name == 'mkdir':
+                    cmds = [command(C_MKDIR, tlv(A_PATH, tmp), tlv(A_INO, u64(ino)))]
+                else:
+                    cmds = [
+                        command(
+                            C_SYMLINK,
+                            tlv(A_PATH, tmp),
+                            tlv(A_INO, u64(ino)),
+                            tlv(A_PATH_LINK, b'target'),
+                        )
+                    ]
+                cmds.append(
+                    command(C_RENAME, tlv(A_PATH, tmp), tlv(A_PATH_TO, path.encode()))
+                )
+                cmds.append(command(C_UTIMES, tlv(A_PATH, path.encode()), now))
+
+            else:
+                i = rng.randrange(len(files))
+                path = files[i].encode()
+
+                if name == 'rename':
+                    new_ino, new = new_path('r')
+                    if rng.random() < 0.5:
+                        # Through a temporary name
+                        tmp = orphan(new_ino)
+                        cmds = [
+                            command(C_RENAME, tlv(A_PATH, path), tlv(A_PATH_TO, tmp)),
+                            command(
+                                C_RENAME, tlv(A_PATH, tmp), tlv(A_PATH_TO, new.encode())
+                            ),
+                        ]
+                    else:
+                        cmds = [
+                            command(
+                                C_RENAME,
+                                tlv(A_PATH, path),
+                                tlv(A_PATH_TO, new.encode()),
+                            )
+                        ]
+                    files[i] = new
+                elif name == 'link':
+                    _, new = new_path('l')
+                    cmds = [
+                        command(
+                            C_LINK, tlv(A_PATH, new.encode()), tlv(A_PATH_LINK, path)
+                        )
+                    ]
+                elif name == 'unlink':
+                    cmds = [command(C_UNLINK, tlv(A_PATH, path))]
+                    files[i] = files[-1]
+                    files.pop()
+                elif name == 'update_extent':
+                    cmds = [
+                        command(
+                            C_UPDATE_EXTENT,
+                            tlv(A_PATH, path),
+                            tlv(A_FILE_OFFSET, u64(rng.randrange(256) * 4096)),
+                            tlv(A_SIZE, u64(4096)),
+                        )
+                    ]
+                elif name == 'write':
+                    cmds = [
+                        command(
+                            C_WRITE,
+                            tlv(A_PATH, path),
+                            tlv(A_FILE_OFFSET, u64(rng.randrange(256) * data_size)),
+                            data,
+                        )
+                    ]
+                elif name == 'encoded_write':
+                    cmds = [
+                        command(
+                            C_ENCODED_WRITE,
+                            tlv(A_PATH, path),
+                            tlv(A_FILE_OFFSET, u64(rng.randrange(64) * 4 * data_size)),
+                            encoding,
+                            encoded,
+                        )
+                    ]
+                elif name == 'fallocate':
+                    cmds = [
+                        command(
+                            C_FALLOCATE,
+                            tlv(A_PATH, path),
+                            tlv(A_FALLOCATE_MODE, (1).to_bytes(4, 'little')),
+                            tlv(A_FILE_OFFSET, u64(rng.randrange(256) * 4096)),
+                            tlv(A_SIZE, u64(4096)),
+                        )
+                    ]
+                elif name == 'truncate':
+                    cmds = [
+                        command(
+                            C_TRUNCATE,
+                            tlv(A_PATH, path),
+                            tlv(A_SIZE, u64(rng.randrange(1 << 20))),
+                        )
+                    ]
+                elif name == 'chown':
+                    cmds = [command(C_CHOWN, tlv(A_PATH, path), owner)]
+                elif name == 'chmod':
+                    cmds = [
+                        command(C_CHMOD, tlv(A_PATH, path), tlv(A_MODE, u64(0o644)))
+                    ]
+                elif name == 'utimes':
+                    cmds = [command(C_UTIMES, tlv(A_PATH, path), now)]
+                else:
+                    cmds = [
+                        command(
+                            C_SET_XATTR,
+                            tlv(A_PATH, path),
+                            tlv(A_XATTR_NAME, b'user.bench'),
+                            tlv(A_XATTR_DATA, b'value'),
+                        )
+                    ]
+
+            f_out.write(b''.join(cmds))
+            written += len(cmds)
+            if written >= count:
+                break
+
+    f_out.write(command(C_END))
+    return written + 2
+
+
+def load(script):
+    ''' Imports btrfs-snapshots-diff.py (not a valid module name) '''
+    spec = importlib.util.spec_from_file_location('btrfs_snapshots_diff', script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def max_rss():
+    ''' Peak memory of this process, in MB '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def call_with_out(function, out, *args):
+    ''' Calls function writing to out, through stdout for versions of
+    btrfs-snapshots-diff.py without out argument '''
+    if 'out' in inspect.signature(function).parameters:
+        function(*args, out=out)
+    else:
+        with contextlib.redirect_stdout(out):
+            function(*args)
+
+
+def report(phase, elapsed, count, unit='commands'):
+    ''' Prints time, throughput and peak memory of a phase '''
+    print(
+        f'  {phase:<10} {elapsed:8.2f}s {count / elapsed if elapsed else 0:12.0f} '
+        f'{unit}/s   max RSS {max_rss():8.1f} MB',
+        flush=True,
+    )
+
+
+def bench_stream(module, stream_file, count, compact=False):
+    ''' Times each phase on stream_file, of count commands '''
+    devnull = open(os.devnull, 'w')
+
+    start = time.perf_counter()
+    stream = module.BtrfsStream(stream_file)
+    report('init', time.perf_counter() - start, count)
+
+    kwargs = {}
+    if compact and 'compact' in inspect.signature(stream.decode).parameters:
+        kwargs['compact'] = True
+    start = time.perf_counter()
+    commands, paths = stream.decode(**kwargs)
+    report('decode', time.perf_counter() - start, len(commands))
+
+    start = time.perf_counter()
+    call_with_out(module.print_by_paths, devnull, paths, commands, None, False)
+    report('by path', time.perf_counter() - start, len(commands))
+    del commands, paths
+
+    # Cost of CRC checks, on decoding without keeping commands
+    if 'verify' in inspect.signature(module.BtrfsStream).parameters:
+        for verify in (False, True):
+            start = time.perf_counter()
+            for _ in module.BtrfsStream(stream_file, verify=verify).iter_decode():
+                pass
+            report(
+                'verify' if verify else 'no verify', time.perf_counter() - start, count
+            )
+
+    # CSV and JSON are written as commands are decoded, when supported
+    if hasattr(stream, 'iter_decode'):
+        start = time.perf_counter()
+        cmds = (cmd for _, cmd in module.BtrfsStream(stream_file).iter_decode())
+        call_with_out(module.print_csv, devnull, cmds)
+        report('csv', time.perf_counter() - start, count)
+
+    if hasattr(module, 'write_json'):
+        start = time.perf_counter()
+        cmds = (cmd for _, cmd in module.BtrfsStream(stream_file).iter_decode())
+        module.write_json(cmds, devnull)
+        report('json', time.perf_counter() - start, count)
+
+    devnull.close()
+
+
+def bench_by_path(module, count):
+    ''' Times print_by_paths() on one path with count actions '''
+    path = 'var/spool/hot-file'
+    commands = []
+    for i in range(count):
+        if i % 2:
+            commands.append(
+                {
+                    'command': 'utimes',
+                    'path': path,
+                    'atime': 1610578042.0 + i,
+                    'mtime': 1610578045.0 + i,
+                    'ctime': 1610578045.0 + i,
+                }
+            )
+        else:
+            commands.append(
+                {'command': 'update_extent', 'path': path, 'file_offset': i, 'size': 1}
+            )
+    paths = {path: list(range(count))}
+
+    with open(os.devnull, 'w') as devnull:
+        start = time.perf_counter()
+        call_with_out(module.print_by_paths, devnull, paths, commands, None, False)
+        elapsed = time.perf_counter() - start
+
+    print(f'{count} actions on one path')
+    report('by path', elapsed, count, 'actions')
+
+
+def main():
+    ''' Main ! '''
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark send stream decoding and output"
+    )
+    parser.add_argument(
+        '-n',
+        '--sizes',
+        '--count',
+        default='10k,1M',
+        help='stream sizes in commands, comma separated, e.g. 10k,1M,20M '
+        '(default: %(default)s)',
+    )
+    parser.add_argument(
+        '--depth', type=int, default=3, help='depth of paths (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--mix',
+        type=parse_mix,
+        default=MIX,
+        help='weights of operations, e.g. create=2,write=1 (default: '
+        + ','.join(f'{name}={weight}' for name, weight in MIX.items())
+        + ')',
+    )
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument(
+        '--data-size',
+        type=int,
+        default=4096,
+        help='bytes of data of write commands (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--proto',
+        type=int,
+        choices=(1, 2, 3),
+        default=1,
+        help='send stream version (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--compact', action='store_true', help='decode to a CommandStore'
+    )
+    parser.add_argument(
+        '--actions',
+        type=int,
+        default=100000,
+        help='number of actions on the path of the by-path benchmark (0: skip)',
+    )
+    parser.add_argument(
+        '--generate', metavar='FILE', help='only write a stream of the first size'
+    )
+    parser.add_argument(
+        '--script',
+        default=os.path.join(os.path.dirname(__file__), 'btrfs-snapshots-diff.py'),
+        help='btrfs-snapshots-diff.py to benchmark',
+    )
+    args = parser.parse_args()
+    sizes = [parse_count(size) for size in args.sizes.split(',')]
+    if args.proto < 2 and any(args.mix[name] for name in V2_OPERATIONS):
+        parser.error(f'{", ".join(V2_OPERATIONS)} need --proto 2')
+
+    def write_stream(f_out, count):
+        return generate(
+            f_out, count, args.depth, args.mix, args.seed, args.data_size, args.proto,
+        )
+
+    if args.generate:
+        with open(args.generate, 'wb') as f_out:
+            count = write_stream(f_out, sizes[0])
+        print(f'{args.generate}: {count} commands')
+        return
+
+    if len(sizes) > 1:
+        # One process per size, for peak memory; the last options win
+        for i, size in enumerate(sizes):
+            extra = ['--sizes', str(size)]
+            if i < len(sizes) - 1:
+                extra += ['--actions', '0']
+            subprocess.run(
+                [sys.executable, __file__] + sys.argv[1:] + extra, check=True
+            )
+        return
+
+    module = load(args.script)
+
+    with tempfile.NamedTemporaryFile(suffix='.btrfs-stream') as f_stream:
+        start = time.perf_counter()
+        count = write_stream(f_stream, sizes[0])
+        f_stream.flush()
+        print(
+            f'{count} commands, {os.path.getsize(f_stream.name) / 2 ** 20:.1f} MB, '
+            f'generated in {time.perf_counter() - start:.2f}s',
+            flush=True,
+        )
+        bench_stream(module, f_stream.name, count, args.compact)
+
+    if args.actions:
+        bench_by_path(module, args.actions)
+
+
+if __name__ == '__main__':
+    main()
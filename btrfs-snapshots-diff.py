@@ -38,507 +38,3920 @@ Copyright (c) 2016-2021 Jean-Denis Girard <jd.girard@sysnux.pf>
 '''
 
 import time
+import asyncio
+import json
+import re
 import argparse
+import fnmatch
+import glob
+import hashlib
+import heapq
+import marshal
+import resource
 import subprocess
-from os import unlink
-from sys import exit, stderr  # pylint: disable=redefined-builtin
-from struct import unpack
-from collections import OrderedDict
+from bisect import bisect_left, bisect_right
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+from io import StringIO
+from os import (
+    O_CLOEXEC,
+    O_NONBLOCK,
+    close,
+    environ,
+    fsencode,
+    fstat,
+    lstat,
+    makedirs,
+    read,
+    replace,
+    scandir,
+    sysconf,
+    unlink,
+    utime,
+)
+from os.path import expanduser, join as path_join
+from tempfile import NamedTemporaryFile, TemporaryFile
+from sys import (
+    byteorder,
+    exit,  # pylint: disable=redefined-builtin
+    intern,
+    stderr,
+    stdin,
+    stdout,
+)
+from mmap import mmap, ACCESS_READ
+from signal import SIGTERM
+from socket import socket, AF_UNIX
+from stat import S_ISSOCK
+from struct import Struct, unpack
+from array import array
+from collections import Counter, OrderedDict
+from functools import lru_cache
+from itertools import groupby, repeat
+from operator import itemgetter
+
+try:
+    # Optional, CRC32C in C (pip install crc32c), for --verify
+    from crc32c import crc32c as _crc32c_accel
+except ImportError:
+    _crc32c_accel = None
 
 printerr = stderr.write
 
+# Attribute value decoders: (buffer, start, end) => value
+s_u64 = Struct('<Q')
+s_timespec = Struct('<QL')
+
+
+def _attr_string(buf, start, end):
+    return str(buf[start:end], 'utf8')
+
+
+def _attr_u64(buf, start, _):
+    return s_u64.unpack_from(buf, start)[0]
+
+
+def _attr_uint(buf, start, end):
+    # Integers narrower than u64 (u8, u32) of v2+ attributes
+    return int.from_bytes(buf[start:end], 'little')
+
+
+def _attr_uuid(buf, start, _):
+    return buf[start : start + 16].hex()
+
+
+def _attr_timespec(buf, start, _):
+    sec, nanos = s_timespec.unpack_from(buf, start)
+    return float(sec) + nanos * 1e-9
+
+
+def _attr_bytes(buf, start, end):
+    return bytes(buf[start:end])
+
+
+def _attr_data(buf, start, end):
+    # memoryview on the attribute value, without copy
+    return buf[start:end]
+
+
+class DataRef:
+    ''' Data attribute of a send stream, not read: offset and length of the
+    value in the stream, see BtrfsStream.read_data(). len() gives the
+    length of the data, as for the memoryview of a data attribute '''
+
+    __slots__ = ('offset', 'length')
+
+    def __init__(self, offset, length):
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return f'DataRef(offset={self.offset}, length={self.length})'
+
+
+def _compile_schema(send_cmds, send_attrs, cmd_schema):
+    ''' Returns a list indexed by command number of (template, keys):
+    template is the decoded command with keys in output order, keys maps
+    attribute number => key
+    '''
+    table = []
+    for cmd in send_cmds:
+        schema = cmd_schema[cmd[13:]]
+        template = {'command': cmd[13:].lower()}
+        template.update((k, None) for _, k in schema)
+        keys = {send_attrs.index(f'BTRFS_SEND_A_{a}'): k for a, k in schema}
+        table.append((template, keys))
+    return table
+
+
+# CRC32C (Castagnoli) polynomial, reflected
+CRC32C_POLY = 0x82F63B78
+
+
+@lru_cache(maxsize=None)
+def _crc32c_tables():
+    ''' Slicing-by-8 tables: tables[k][byte] is the CRC of byte followed by
+    k zero bytes '''
+    table = []
+    for crc in range(256):
+        for _ in range(8):
+            crc = crc >> 1 ^ (CRC32C_POLY if crc & 1 else 0)
+        table.append(crc)
+    tables = [table]
+    for _ in range(7):
+        tables.append([crc >> 8 ^ table[crc & 0xFF] for crc in tables[-1]])
+    return tables
+
+
+def crc32c(data, crc=0):
+    ''' CRC32C of data (bytes-like) continuing from crc, as computed by btrfs
+    send: initial value 0 and no final inversion.
+    Uses the crc32c module if installed, else processes 8 bytes at a time
+    with slicing-by-8 tables '''
+    if _crc32c_accel is not None:
+        # crc32c module inverts before and after
+        return _crc32c_accel(data, crc ^ 0xFFFFFFFF) ^ 0xFFFFFFFF
+
+    t0, t1, t2, t3, t4, t5, t6, t7 = _crc32c_tables()
+    data = memoryview(data)
+    n_words = len(data) & ~7
+    words = data[:n_words].cast('Q')
+    if byteorder == 'big':
+        words = array('Q', words)
+        words.byteswap()
+    for word in words:
+        crc ^= word
+        crc = (
+            t7[crc & 0xFF]
+            ^ t6[crc >> 8 & 0xFF]
+            ^ t5[crc >> 16 & 0xFF]
+            ^ t4[crc >> 24 & 0xFF]
+            ^ t3[crc >> 32 & 0xFF]
+            ^ t2[crc >> 40 & 0xFF]
+            ^ t1[crc >> 48 & 0xFF]
+            ^ t0[crc >> 56]
+        )
+    for byte in data[n_words:]:
+        crc = t0[(crc ^ byte) & 0xFF] ^ crc >> 8
+    return crc
+
+
+class StreamStats:
+    ''' Counters and timings of a stream, see BtrfsStream(stats=True)
+
+    counts / sizes: number of commands and bytes (headers included) by
+    command number, paths: number of commands by path, times: seconds
+    spent in phases. read and decode are measured while decoding, send
+    (btrfs send process), render and total by the caller.
+    '''
+
+    def __init__(self, send_cmds):
+        self.names = [cmd[13:].lower() for cmd in send_cmds]
+        self.counts = [0] * len(send_cmds)
+        self.sizes = [0] * len(send_cmds)
+        self.paths = Counter()
+        self.length = 0
+        self.cached = False
+        self.times = dict.fromkeys(('send', 'read', 'decode', 'render', 'total'), 0.0)
+
+    def as_dict(self, top=10):
+        ''' Stats as a dict, with the top largest paths by command count '''
+        commands = sum(self.counts)
+        elapsed = self.times['total'] or self.times['read'] + self.times['decode']
+        return {
+            'commands': commands,
+            'bytes': self.length,
+            'cached': self.cached,
+            'times': self.times,
+            'commands_per_s': commands / elapsed if elapsed else None,
+            'mb_per_s': self.length / 2 ** 20 / elapsed if elapsed else None,
+            'opcodes': {
+                name: {'count': count, 'bytes': size}
+                for name, count, size in zip(self.names, self.counts, self.sizes)
+                if count
+            },
+            'largest_paths': self.paths.most_common(top),
+        }
+
+    def format(self, top=10):
+        ''' Stats as text lines '''
+        stats = self.as_dict(top)
+        lines = [
+            f'{stats["commands"]} commands, {stats["bytes"]} bytes'
+            + (' (cached stream)' if self.cached else '')
+        ]
+        lines.append(
+            'times: ' + ', '.join(f'{name} {t:.3f}s' for name, t in self.times.items())
+        )
+        if stats['commands_per_s'] is not None:
+            lines.append(
+                f'throughput: {stats["commands_per_s"]:.0f} commands/s, '
+                f'{stats["mb_per_s"]:.1f} MB/s'
+            )
+        for name, opcode in stats['opcodes'].items():
+            lines.append(
+                f'{name:>15}: {opcode["count"]} commands, {opcode["bytes"]} bytes'
+            )
+        if stats['largest_paths']:
+            lines.append('largest paths:')
+            lines.extend(
+                f'{count:>15}: {path or "__sub_root__"}'
+                for path, count in stats['largest_paths']
+            )
+        return '\n'.join(lines) + '\n'
+
+
+class StreamError(ValueError):
+    ''' Invalid send stream (bad header, truncated, unknown command...),
+    offset is the position of the faulty command in the stream if known '''
+
+    def __init__(self, message, offset=None):
+        super().__init__(message)
+        self.offset = offset
+
+
+class CRCError(StreamError):
+    ''' CRC32C of a command does not match, see BtrfsStream(verify=True) '''
+
+
+class BtrfsStream:
+    ''' Btrfs send stream representation
+
+    Can be used as a context manager, releasing the stream on exit:
+    with BtrfsStream('/tmp/snaps-diff') as stream:
+        for command in stream.iter_commands():
+            ...
+    '''
+
+    # From btrfs/send.h: v1, then v2 (fallocate, fileattr, encoded_write)
+    # and v3 (enable_verity) commands and attributes
+    send_cmds = 'BTRFS_SEND_C_UNSPEC BTRFS_SEND_C_SUBVOL BTRFS_SEND_C_SNAPSHOT BTRFS_SEND_C_MKFILE BTRFS_SEND_C_MKDIR BTRFS_SEND_C_MKNOD BTRFS_SEND_C_MKFIFO BTRFS_SEND_C_MKSOCK BTRFS_SEND_C_SYMLINK BTRFS_SEND_C_RENAME BTRFS_SEND_C_LINK BTRFS_SEND_C_UNLINK BTRFS_SEND_C_RMDIR BTRFS_SEND_C_SET_XATTR BTRFS_SEND_C_REMOVE_XATTR BTRFS_SEND_C_WRITE BTRFS_SEND_C_CLONE BTRFS_SEND_C_TRUNCATE BTRFS_SEND_C_CHMOD BTRFS_SEND_C_CHOWN BTRFS_SEND_C_UTIMES BTRFS_SEND_C_END BTRFS_SEND_C_UPDATE_EXTENT BTRFS_SEND_C_FALLOCATE BTRFS_SEND_C_FILEATTR BTRFS_SEND_C_ENCODED_WRITE BTRFS_SEND_C_ENABLE_VERITY'.split()
+
+    send_attrs = 'BTRFS_SEND_A_UNSPEC BTRFS_SEND_A_UUID BTRFS_SEND_A_CTRANSID BTRFS_SEND_A_INO BTRFS_SEND_A_SIZE BTRFS_SEND_A_MODE BTRFS_SEND_A_UID BTRFS_SEND_A_GID BTRFS_SEND_A_RDEV BTRFS_SEND_A_CTIME BTRFS_SEND_A_MTIME BTRFS_SEND_A_ATIME BTRFS_SEND_A_OTIME BTRFS_SEND_A_XATTR_NAME BTRFS_SEND_A_XATTR_DATA BTRFS_SEND_A_PATH BTRFS_SEND_A_PATH_TO BTRFS_SEND_A_PATH_LINK BTRFS_SEND_A_FILE_OFFSET BTRFS_SEND_A_DATA BTRFS_SEND_A_CLONE_UUID BTRFS_SEND_A_CLONE_CTRANSID BTRFS_SEND_A_CLONE_PATH BTRFS_SEND_A_CLONE_OFFSET BTRFS_SEND_A_CLONE_LEN BTRFS_SEND_A_FALLOCATE_MODE BTRFS_SEND_A_FILEATTR BTRFS_SEND_A_UNENCODED_FILE_LEN BTRFS_SEND_A_UNENCODED_LEN BTRFS_SEND_A_UNENCODED_OFFSET BTRFS_SEND_A_COMPRESSION BTRFS_SEND_A_ENCRYPTION BTRFS_SEND_A_VERITY_ALGORITHM BTRFS_SEND_A_VERITY_BLOCK_SIZE BTRFS_SEND_A_VERITY_SALT_DATA BTRFS_SEND_A_VERITY_SIG_DATA'.split()
+
+    # Decoder for each attribute type
+    attr_decoders = {
+        'UUID': _attr_uuid,
+        'CTRANSID': _attr_u64,
+        'INO': _attr_u64,
+        'SIZE': _attr_u64,
+        'MODE': _attr_u64,
+        'UID': _attr_u64,
+        'GID': _attr_u64,
+        'RDEV': _attr_u64,
+        'CTIME': _attr_timespec,
+        'MTIME': _attr_timespec,
+        'ATIME': _attr_timespec,
+        'OTIME': _attr_timespec,
+        'XATTR_NAME': _attr_string,
+        'XATTR_DATA': _attr_bytes,
+        'PATH': _attr_string,
+        'PATH_TO': _attr_string,
+        'PATH_LINK': _attr_string,
+        'FILE_OFFSET': _attr_u64,
+        'DATA': _attr_data,
+        'CLONE_UUID': _attr_uuid,
+        'CLONE_CTRANSID': _attr_u64,
+        'CLONE_PATH': _attr_string,
+        'CLONE_OFFSET': _attr_u64,
+        'CLONE_LEN': _attr_u64,
+        'FALLOCATE_MODE': _attr_uint,
+        'FILEATTR': _attr_u64,
+        'UNENCODED_FILE_LEN': _attr_u64,
+        'UNENCODED_LEN': _attr_u64,
+        'UNENCODED_OFFSET': _attr_u64,
+        'COMPRESSION': _attr_uint,
+        'ENCRYPTION': _attr_uint,
+        'VERITY_ALGORITHM': _attr_uint,
+        'VERITY_BLOCK_SIZE': _attr_uint,
+        'VERITY_SALT_DATA': _attr_bytes,
+        'VERITY_SIG_DATA': _attr_bytes,
+    }
+
+    # Decoding schema: for each command, attribute => key in the decoded
+    # command, in output order. Attributes not listed are skipped. PATH is
+    # always decoded, as commands are grouped by path.
+    cmd_schema = {
+        'UNSPEC': (),
+        'SUBVOL': (('PATH', 'path'), ('UUID', 'uuid'), ('CTRANSID', 'ctrans_id')),
+        'SNAPSHOT': (
+            ('PATH', 'path'),
+            ('UUID', 'uuid'),
+            ('CTRANSID', 'ctransid'),
+            ('CLONE_UUID', 'clone_uuid'),
+            ('CLONE_CTRANSID', 'clone_ctransid'),
+        ),
+        'MKFILE': (('PATH', 'path'),),
+        'MKDIR': (('PATH', 'path'),),
+        'MKNOD': (('PATH', 'path'), ('MODE', 'mode'), ('RDEV', 'rdev')),
+        'MKFIFO': (('INO', 'ino'), ('PATH', 'path'), ('RDEV', 'rdev')),
+        'MKSOCK': (('INO', 'ino'), ('PATH', 'path'), ('RDEV', 'rdev')),
+        'SYMLINK': (('PATH_LINK', 'path_link'), ('INO', 'inode')),
+        'RENAME': (('PATH', 'path'), ('PATH_TO', 'path_to')),
+        'LINK': (('PATH', 'path'), ('PATH_LINK', 'path_link')),
+        'UNLINK': (('PATH', 'path'),),
+        'RMDIR': (('PATH', 'path'),),
+        'SET_XATTR': (
+            ('PATH', 'path'),
+            ('XATTR_NAME', 'xattr_name'),
+            ('XATTR_DATA', 'xattr_data'),
+        ),
+        'REMOVE_XATTR': (('PATH', 'path'), ('XATTR_NAME', 'xattr_name')),
+        'WRITE': (('PATH', 'path'), ('FILE_OFFSET', 'file_offset'), ('DATA', 'data')),
+        'CLONE': (
+            ('PATH', 'path'),
+            ('FILE_OFFSET', 'file_offset'),
+            ('CLONE_LEN', 'clone_len'),
+            ('CLONE_UUID', 'clone_uuid'),
+            ('CLONE_CTRANSID', 'clone_transid'),
+            ('CLONE_PATH', 'clone_path'),
+            ('CLONE_OFFSET', 'clone_offset'),
+        ),
+        'TRUNCATE': (('PATH', 'path'), ('SIZE', 'to_size')),
+        'CHMOD': (('PATH', 'path'), ('MODE', 'mode')),
+        'CHOWN': (('PATH', 'path'), ('UID', 'user_id'), ('GID', 'group_id')),
+        'UTIMES': (
+            ('PATH', 'path'),
+            ('ATIME', 'atime'),
+            ('MTIME', 'mtime'),
+            ('CTIME', 'ctime'),
+        ),
+        'END': (),
+        'UPDATE_EXTENT': (
+            ('PATH', 'path'),
+            ('FILE_OFFSET', 'file_offset'),
+            ('SIZE', 'size'),
+        ),
+        'FALLOCATE': (
+            ('PATH', 'path'),
+            ('FALLOCATE_MODE', 'fallocate_mode'),
+            ('FILE_OFFSET', 'file_offset'),
+            ('SIZE', 'size'),
+        ),
+        'FILEATTR': (('PATH', 'path'), ('FILEATTR', 'fileattr')),
+        'ENCODED_WRITE': (
+            ('PATH', 'path'),
+            ('FILE_OFFSET', 'file_offset'),
+            ('UNENCODED_FILE_LEN', 'unencoded_file_len'),
+            ('UNENCODED_LEN', 'unencoded_len'),
+            ('UNENCODED_OFFSET', 'unencoded_offset'),
+            ('COMPRESSION', 'compression'),
+            ('ENCRYPTION', 'encryption'),
+            ('DATA', 'data'),
+        ),
+        'ENABLE_VERITY': (
+            ('PATH', 'path'),
+            ('VERITY_ALGORITHM', 'verity_algorithm'),
+            ('VERITY_BLOCK_SIZE', 'verity_block_size'),
+            ('VERITY_SALT_DATA', 'verity_salt'),
+            ('VERITY_SIG_DATA', 'verity_sig'),
+        ),
+    }
+
+    # Headers length
+    l_head = 10
+    l_tlv = 4
+    # Since v2, the data attribute has a type but no length
+    l_type = 2
+
+    # Latest supported stream version
+    max_version = 3
+
+    # Precompiled structures, used with unpack_from() at an offset of the
+    # stream buffer so that no intermediate bytes object is created
+    s_head = Struct('<IHI')
+    s_head_cmd = Struct('<IH')
+    s_tlv = Struct('<HH')
+    # Type alone, for a data attribute (no length since v2) ending the buffer
+    s_u16 = Struct('<H')
+
+    # Streams smaller than this are not worth decoding in parallel
+    parallel_length = 16 << 20
+
+    C_RENAME = send_cmds.index('BTRFS_SEND_C_RENAME')
+    C_END = send_cmds.index('BTRFS_SEND_C_END')
+    A_PATH = send_attrs.index('BTRFS_SEND_A_PATH')
+    A_DATA = send_attrs.index('BTRFS_SEND_A_DATA')
+
+    # Dispatch tables, indexed by attribute / command number
+    attr_table = list(map(attr_decoders.get, (attr[13:] for attr in send_attrs)))
+    cmd_table = _compile_schema(send_cmds, send_attrs, cmd_schema)
+
+    def __init__(self, stream_file, delete=False, stats=False, verify=False):
+        ''' stream_file is either a path, '-' for stdin, or a binary file
+        object (e.g. the stdout pipe of "btrfs send"). Paths are memory-mapped,
+        pipes are decoded incrementally, one command at a time.
+        With stats, decoding updates a StreamStats in self.stats.
+        With verify, the CRC32C of each command is checked while reading, a
+        CRCError is raised on the first mismatch.
+        Raises OSError if stream_file can't be read, StreamError if it is not
+        a send stream.
+        '''
+
+        self.stream = None
+        self.pipe = None
+        self.version = None
+        self.stats = StreamStats(self.send_cmds) if stats else None
+        self.verify = verify
+        # Stream file path, that can be opened again (e.g. by other processes)
+        self.path = None
+
+        if stream_file == '-':
+            self.pipe = stdin.buffer
+        elif hasattr(stream_file, 'read'):
+            self.pipe = stream_file
+        elif not delete:
+            self.path = stream_file
+
+        # Read send stream
+        if self.pipe is not None:
+            header = self.pipe.read(17)
+        else:
+            with open(stream_file, 'rb') as f_stream:
+                if fstat(f_stream.fileno()).st_size:
+                    self.stream = memoryview(
+                        mmap(f_stream.fileno(), 0, access=ACCESS_READ)
+                    )
+                else:
+                    # Empty files can't be mapped
+                    self.stream = memoryview(b'')
+            header = self.stream[0:17]
+
+        if delete and self.pipe is None:
+            try:
+                unlink(stream_file)
+            except OSError:
+                printerr(f'Warning: could not delete stream file "{stream_file}"\n')
+
+        # Number of bytes consumed so far (whole stream when read from a file)
+        self.length = len(header) if self.stream is None else len(self.stream)
+
+        if len(header) < 17:
+            raise StreamError('Invalid stream length', 0)
+
+        magic, _, version = unpack('<12scI', header)
+        if magic != b'btrfs-stream':
+            raise StreamError('Not a Btrfs stream!', 0)
+        if not 1 <= version <= self.max_version:
+            raise StreamError(f'Unsupported stream version {version}', 0)
+        self.version = version
+        # Since v2, data is the last attribute of a command and runs to its
+        # end, without length (-1: no such attribute in v1)
+        self.a_data_end = self.A_DATA if version >= 2 else -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        ''' Unmaps the stream file, or closes the pipe (except stdin) '''
+        if self.stream is not None:
+            mapped = self.stream.obj
+            self.stream.release()
+            self.stream = None
+            if isinstance(mapped, mmap):
+                try:
+                    mapped.close()
+                except BufferError:
+                    # Attributes still referenced, unmapped once released
+                    pass
+        elif self.pipe is not None:
+            if self.pipe is not stdin.buffer:
+                self.pipe.close()
+            self.pipe = None
+
+    def _read_commands(self, span=None):
+        ''' Yields (offset, cmd, buf, index, end) for each command of the
+        stream: offset is the position of the command attributes in the
+        stream, and attributes can be read from buf[index:end].
+        From a pipe, buf only holds the current command, so memory use does
+        not depend on stream length.
+        span (start, stop) selects commands whose headers are in
+        stream[start:stop] (memory-mapped streams only), stop may be None.
+        With self.verify, commands are only yielded once their CRC is checked.
+        '''
+        offset, stop = (17, None) if span is None else span
+        stats = self.stats
+        verify = self.verify
+        while stop is None or offset < stop:
+            if self.pipe is None:
+                if offset + self.l_head > self.length:
+                    raise StreamError(f'Truncated stream at offset {offset}', offset)
+                l_cmd, cmd, crc = self.s_head.unpack_from(self.stream, offset)
+                buf, index = self.stream, offset + self.l_head
+                if index + l_cmd > self.length:
+                    raise StreamError(f'Truncated stream at offset {offset}', offset)
+            else:
+                if stats is not None:
+                    start = time.perf_counter()
+                header = self.pipe.read(self.l_head)
+                if len(header) < self.l_head:
+                    raise StreamError(f'Truncated stream at offset {offset}', offset)
+                l_cmd, cmd, crc = self.s_head.unpack(header)
+                buf, index = memoryview(self.pipe.read(l_cmd)), 0
+                if len(buf) < l_cmd:
+                    raise StreamError(f'Truncated stream at offset {offset}', offset)
+                self.length += self.l_head + l_cmd
+                if stats is not None:
+                    stats.times['read'] += time.perf_counter() - start
+            if verify:
+                # CRC of the header (with CRC field set to 0) and attributes
+                computed = crc32c(
+                    buf[index : index + l_cmd], crc32c(self.s_head.pack(l_cmd, cmd, 0))
+                )
+                if computed != crc:
+                    raise CRCError(
+                        f'CRC error in command at offset {offset}: '
+                        f'{crc:#010x} in stream, {computed:#010x} computed',
+                        offset,
+                    )
+            offset += self.l_head
+            yield offset, cmd, buf, index, index + l_cmd
+            offset += l_cmd
+
+    def command_offsets(self):
+        ''' Returns an array of the offsets of command headers, up to END,
+        reading only headers (memory-mapped streams only) '''
+        if self.stream is None:
+            raise ValueError('Offsets index needs a stream file')
+        offsets = array('Q')
+        append = offsets.append
+        unpack_head = self.s_head_cmd.unpack_from
+        stream = self.stream
+        l_head = self.l_head
+        c_end = self.C_END
+        offset = 17
+        # Only one unpack and one append per command
+        while offset + l_head <= self.length:
+            append(offset)
+            l_cmd, cmd = unpack_head(stream, offset)
+            if cmd == c_end:
+                return offsets
+            offset += l_head + l_cmd
+        raise StreamError(f'Truncated stream at offset {offset}', offset)
+
+    def read_data(self, ref):
+        ''' Data of a DataRef of this stream, as a memoryview on the stream
+        (memory-mapped streams only, data read from a pipe is not kept) '''
+        if self.stream is None:
+            raise ValueError('Reading data needs a stream file')
+        return self.stream[ref.offset : ref.offset + ref.length]
+
+    @classmethod
+    def skipped_cmds(cls, include=None, exclude=None):
+        ''' Set of command numbers not in include or in exclude (command
+        names, e.g. 'mkfile'), END is never skipped.
+        Raises ValueError for unknown command names '''
+        names = [cmd[13:].lower() for cmd in cls.send_cmds]
+        exclude = set(exclude or ())
+        unknown = exclude.union(include or ()).difference(names)
+        if unknown:
+            raise ValueError(f'Unknown command: {", ".join(sorted(unknown))}')
+        return {
+            cmd
+            for cmd, name in enumerate(names)
+            if cmd != cls.C_END
+            and (include is not None and name not in include or name in exclude)
+        }
+
+    def iter_commands(self, include=None, exclude=None):
+        ''' Yields a Command for each command of the stream, up to END, only
+        reading command numbers: paths and attributes are decoded when
+        accessed. include / exclude select commands by name, see
+        skipped_cmds() '''
+        skipped = self.skipped_cmds(include, exclude)
+        n_cmds = len(self.cmd_table)
+
+        for offset, cmd, buf, index, end in self._read_commands():
+            if cmd >= n_cmds:
+                raise StreamError(f'Unknown command {cmd}', offset - self.l_head)
+            if cmd in skipped:
+                continue
+            yield Command(cmd, offset - self.l_head, buf, index, end, self.a_data_end)
+            if cmd == self.C_END:
+                break
+
+    def iter_paths(self, include=None, exclude=None):
+        ''' Yields (path, [Command, ...]) for each path, in order of first
+        appearance. Commands are grouped by their PATH attribute (commands not
+        related to a path are left out), so the whole stream is read before
+        the first path is yielded '''
+        paths = OrderedDict()
+        for command in self.iter_commands(include, exclude):
+            path = command.path
+            if path is not None:
+                paths.setdefault(path, []).append(command)
+        yield from paths.items()
+
+    def iter_decode(
+        self,
+        bogus=True,
+        include=None,
+        exclude=None,
+        path_filter=None,
+        span=None,
+        data=False,
+    ):
+        ''' Decodes commands + attributes from send stream, yielding
+        (path, command) as they are read; path is None for commands not
+        related to a path
+        Commands can be selected as early as possible: by type with include
+        / exclude (command names), their attributes are then not even read,
+        and by path with path_filter(path) => bool, decoding stops at the
+        first PATH attribute not selected (END is always yielded)
+        span limits decoding to part of the stream, see _read_commands()
+        Data of v2+ streams (write and encoded_write payloads) is given as
+        a DataRef, without reading it, or as a memoryview with data (v1
+        data is always a memoryview)
+        '''
+        cmd_table = self.cmd_table
+        attr_table = self.attr_table
+        tlv_unpack = self.s_tlv.unpack_from
+        u16_unpack = self.s_u16.unpack_from
+        l_type = self.l_type
+        l_tlv = self.l_tlv
+        a_path = self.A_PATH
+        a_data_end = self.a_data_end
+        stats = self.stats
+        skipped = self.skipped_cmds(include, exclude)
+
+        for offset, cmd, buf, index, end in self._read_commands(span):
+
+            if cmd in skipped:
+                continue
+
+            if stats is not None:
+                start = time.perf_counter()
+                l_cmd = end - index
+
+            try:
+                template, keys = cmd_table[cmd]
+            except IndexError:
+                raise StreamError(f'Unknown command {cmd}', offset - self.l_head)
+
+            command = template.copy()
+            path = None
+            skip = False
+            # Renamed to a selected path from a path not selected
+            renamed = bogus and cmd == self.C_RENAME
+
+            # Position in the stream of buf[0]
+            base = offset - index
+
+            # Attributes may come in any order
+            while index < end:
+                if index + l_tlv <= end:
+                    attr, l_attr = tlv_unpack(buf, index)
+                else:
+                    # Data of less than 2 bytes, at the end of the buffer
+                    # when read from a pipe
+                    attr = u16_unpack(buf, index)[0]
+                    l_attr = None
+                key = keys.get(attr)
+                if attr == a_data_end:
+                    index += l_type
+                    if key is not None:
+                        command[key] = (
+                            buf[index:end]
+                            if data
+                            else DataRef(base + index, end - index)
+                        )
+                    break
+                if l_attr is None:
+                    raise StreamError(f'Truncated attribute {attr}', base + index)
+                index += l_tlv
+                if attr == a_path:
+                    path = _attr_string(buf, index, index + l_attr)
+                    if path_filter is not None and not path_filter(path):
+                        skip = True
+                        if not renamed:
+                            break
+                    if key is not None:
+                        command[key] = path
+                elif key is not None:
+                    command[key] = attr_table[attr](buf, index, index + l_attr)
+                index += l_attr
+
+            if path is None and path_filter is not None and cmd != self.C_END:
+                skip = True
+            if skip and not renamed:
+                continue
+
+            if stats is not None:
+                stats.counts[cmd] += 1
+                stats.sizes[cmd] += self.l_head + l_cmd
+                if path is not None:
+                    stats.paths[path] += 1
+                stats.length = self.length
+                stats.times['decode'] += time.perf_counter() - start
+
+            if cmd == self.C_END:
+                command['headers_length'] = offset
+                command['stream_length'] = self.length
+                yield None, command
+                break
+
+            if renamed and (path_filter is None or path_filter(command['path_to'])):
+                # Add bogus renamed_from command on destination to keep track
+                # of what happened
+                yield command['path_to'], {
+                    'command': 'renamed_from',
+                    'path': path,
+                    'path_to': command['path_to'],
+                }
+
+            if not skip:
+                yield path, command
+
+    def decode(
+        self, bogus=True, compact=False, changes=None, jobs=1, inodes=None, **select
+    ):
+        ''' Decodes commands + attributes from send stream
+        With compact, commands are kept in a CommandStore instead of a list
+        With changes (a NetChanges), net changes are resolved in the same pass
+        With inodes (an InodeIndex), commands are indexed by inode too
+        select (include, exclude, path_filter) is given to iter_decode()
+        With jobs > 1, large stream files are decoded in parallel, see
+        decode_parallel()
+        '''
+        if (
+            jobs > 1
+            and self.path is not None
+            and self.length >= self.parallel_length
+            and changes is None
+            and inodes is None
+            and self.stats is None
+            and select.get('path_filter') is None
+        ):
+            return self.decode_parallel(jobs, bogus, compact, **select)
+
+        # List of commands sequentially decoded
+        commands = CommandStore() if compact else []
+        # Modified paths: path => [cmd_ref1, cmd_ref2, ...]
+        paths = PathIndex()
+
+        for cmd_ref, (path, command) in enumerate(self.iter_decode(bogus, **select)):
+            if path is not None:
+                paths.add(path, cmd_ref)
+            if changes is not None:
+                changes.add(path, command)
+            if inodes is not None:
+                inodes.add(path, cmd_ref, command)
+            commands.append(command)
+
+        return commands, paths
+
+    def decode_parallel(self, jobs, bogus=True, compact=False, **select):
+        ''' Same as decode(), in up to jobs worker processes: the stream is
+        split in chunks of commands using the offsets index, each chunk is
+        decoded by _decode_span() in a worker, and chunks are merged in
+        stream order. The stream must be a file, and path_filter can't be
+        used (functions are not sent to workers) '''
+        offsets = self.command_offsets()
+        # More chunks than jobs, so that a slow chunk does not delay others
+        n_chunks = min(jobs * 4, len(offsets))
+        bounds = [offsets[len(offsets) * i // n_chunks] for i in range(n_chunks)]
+        spans = list(zip(bounds, bounds[1:] + [None]))
+
+        commands = CommandStore() if compact else []
+        paths = PathIndex()
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = executor.map(
+                _decode_span,
+                repeat(self.path),
+                spans,
+                repeat(bogus),
+                repeat(self.verify),
+                repeat(select),
+            )
+            for chunk_commands, chunk_paths in results:
+                # Command numbers of the chunk start from 0
+                first_ref = len(commands)
+                for path, cmd_refs in chunk_paths.items():
+                    paths.add_refs(path, cmd_refs, first_ref)
+                if compact:
+                    for command in chunk_commands:
+                        commands.append(command)
+                else:
+                    commands.extend(chunk_commands)
+
+        return commands, paths
+
+
+def _decode_span(stream_file, span, bogus, verify, select):
+    ''' Decodes commands of stream_file whose headers are in span, in a
+    worker process of BtrfsStream.decode_parallel(). Returns (commands,
+    {path: [cmd_ref, ...]}), cmd_refs starting from 0 '''
+    commands = []
+    paths = {}
+    with BtrfsStream(stream_file, verify=verify) as stream:
+        decoded = stream.iter_decode(bogus, span=span, **select)
+        for cmd_ref, (path, command) in enumerate(decoded):
+            if path is not None:
+                paths.setdefault(path, []).append(cmd_ref)
+            if type(command.get('data')) is memoryview:
+                # Data is a view on the stream, that can't be sent back
+                command['data'] = bytes(command['data'])
+            commands.append(command)
+    return commands, paths
+
+
+class Command:
+    ''' Command of a send stream, see BtrfsStream.iter_commands()
+
+    cmd is the command number, offset its position in the stream. path and
+    attrs (the command as a dict, like BtrfsStream.iter_decode() yields it)
+    are decoded on first access; for memory-mapped streams, this must happen
+    before the stream is closed. a_data_end is the data attribute of v2+
+    streams, that runs to the end of the command (-1 for v1).
+    '''
+
+    __slots__ = ('cmd', 'offset', '_buf', '_start', '_end', '_a_data_end', '_attrs')
+
+    def __init__(self, cmd, offset, buf, start, end, a_data_end=-1):
+        self.cmd = cmd
+        self.offset = offset
+        self._buf = buf
+        self._start = start
+        self._end = end
+        self._a_data_end = a_data_end
+        self._attrs = None
+
+    def __repr__(self):
+        return f'Command({self.name!r}, path={self.path!r}, offset={self.offset})'
+
+    def __getitem__(self, key):
+        return self.attrs[key]
+
+    @property
+    def name(self):
+        ''' Command name, e.g. 'mkfile' '''
+        return BtrfsStream.cmd_table[self.cmd][0]['command']
+
+    @property
+    def path(self):
+        ''' PATH attribute, None for commands not related to a path '''
+        buf = self._buf
+        index = self._start
+        u16_unpack = BtrfsStream.s_u16.unpack_from
+        while index < self._end:
+            attr = u16_unpack(buf, index)[0]
+            if attr == self._a_data_end:
+                break
+            l_attr = u16_unpack(buf, index + BtrfsStream.l_type)[0]
+            index += BtrfsStream.l_tlv
+            if attr == BtrfsStream.A_PATH:
+                return _attr_string(buf, index, index + l_attr)
+            index += l_attr
+        return None
+
+    @property
+    def attrs(self):
+        ''' Decoded command: {'command': name, attribute key: value...} '''
+        if self._attrs is None:
+            template, keys = BtrfsStream.cmd_table[self.cmd]
+            attr_table = BtrfsStream.attr_table
+            self._attrs = attrs = template.copy()
+            buf = self._buf
+            index = self._start
+            end = self._end
+            u16_unpack = BtrfsStream.s_u16.unpack_from
+            while index < end:
+                attr = u16_unpack(buf, index)[0]
+                key = keys.get(attr)
+                if attr == self._a_data_end:
+                    # Not read, as by BtrfsStream.iter_decode()
+                    index += BtrfsStream.l_type
+                    if key is not None:
+                        position = (
+                            self.offset + BtrfsStream.l_head + index - self._start
+                        )
+                        attrs[key] = DataRef(position, end - index)
+                    break
+                l_attr = u16_unpack(buf, index + BtrfsStream.l_type)[0]
+                index += BtrfsStream.l_tlv
+                if key is not None:
+                    attrs[key] = attr_table[attr](buf, index, index + l_attr)
+                index += l_attr
+        return self._attrs
+
+
+class CommandStore:
+    ''' Compact, columnar storage of decoded commands
+
+    Each command is stored as a layout number (command name, keys and value
+    types) and a start index in an array of values: integers are stored as
+    is, strings as indexes in an interned string table, floats and other
+    values as indexes in their own tables.
+    Commands are rebuilt as dicts on access, so a CommandStore can be used
+    like the list of commands returned by BtrfsStream.decode().
+    '''
+
+    def __init__(self):
+        # Layouts: (command name, ((key, type), ...))
+        self.layouts = []
+        self.layout_ids = {}
+        # Interned strings
+        self.strings = []
+        self.string_ids = {}
+        self.floats = array('d')
+        self.objects = []
+        # Columns, one item per command
+        self.cmd_layouts = array('H')
+        self.cmd_starts = array('Q')
+        # Values of all commands
+        self.values = array('Q')
+
+    def __len__(self):
+        return len(self.cmd_layouts)
+
+    def __iter__(self):
+        for i in range(len(self.cmd_layouts)):
+            yield self[i]
+
+    def __getitem__(self, cmd_ref):
+        name, fields = self.layouts[self.cmd_layouts[cmd_ref]]
+        start = self.cmd_starts[cmd_ref]
+        command = {'command': name}
+        for (key, kind), value in zip(fields, self.values[start : start + len(fields)]):
+            if kind is str:
+                value = self.strings[value]
+            elif kind is float:
+                value = self.floats[value]
+            elif kind is object:
+                value = self.objects[value]
+            command[key] = value
+        return command
+
+    def intern(self, string):
+        ''' Returns the index of string in the string table '''
+        string_id = self.string_ids.get(string)
+        if string_id is None:
+            string_id = self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+        return string_id
+
+    def append(self, command):
+        ''' Stores a command dict, 'command' must be its first key '''
+        values = self.values
+        self.cmd_starts.append(len(values))
+        fields = []
+        items = iter(command.items())
+        _, name = next(items)
+        for key, value in items:
+            kind = type(value)
+            if kind is int:
+                values.append(value)
+            elif kind is str:
+                values.append(self.intern(value))
+            elif kind is float:
+                values.append(len(self.floats))
+                self.floats.append(value)
+            else:
+                kind = object
+                values.append(len(self.objects))
+                self.objects.append(value)
+            fields.append((key, kind))
+
+        layout = (name, tuple(fields))
+        layout_id = self.layout_ids.get(layout)
+        if layout_id is None:
+            layout_id = self.layout_ids[layout] = len(self.layouts)
+            self.layouts.append(layout)
+        self.cmd_layouts.append(layout_id)
+
+
+class PathIndex:
+    ''' Modified paths, stored as a trie of interned path components
+
+    Trie nodes are numbers, node 0 being the subvolume root (path ''), and
+    their attributes are stored in arrays indexed by node. Commands of a
+    node are chained: first_refs / last_refs give the first and last
+    command numbers of each node, next_refs the next command number on the
+    same node, by command number.
+    Iterating gives paths in the order they were first seen, like an
+    OrderedDict path => [cmd_ref1, cmd_ref2, ...]; subtree() and
+    changed_dirs() only visit the part of the trie they need.
+    '''
+
+    def __init__(self):
+        self.parents = array('I', [0])
+        self.names = ['']
+        # node => {name: child node}, for nodes having children
+        self.children = {}
+        # -1 when node path is not modified itself
+        self.first_refs = array('i', [-1])
+        self.last_refs = array('i', [-1])
+        self.next_refs = array('i')
+        # Modified nodes, in first-seen order
+        self.nodes = array('I')
+        # Directories are much less numerous than paths: their nodes are
+        # cached by path. Consecutive commands are mostly on the same path.
+        self.dir_nodes = {'': 0}
+        self.last_path = ''
+        self.last_node = 0
+
+    def _node(self, path):
+        ''' Returns node of path, None if not in trie '''
+        node = 0
+        if path == '':
+            return node
+        for name in path.split('/'):
+            node = self.children.get(node, {}).get(name)
+            if node is None:
+                return None
+        return node
+
+    def _child(self, node, name):
+        ''' Returns child node name of node, created if needed '''
+        names = self.children.get(node)
+        if names is None:
+            names = self.children[node] = {}
+        child = names.get(name)
+        if child is None:
+            name = intern(name)
+            child = names[name] = len(self.parents)
+            self.parents.append(node)
+            self.names.append(name)
+            self.first_refs.append(-1)
+            self.last_refs.append(-1)
+        return child
+
+    def _path_node(self, path):
+        ''' Returns node of path, created if needed '''
+        if path == self.last_path:
+            node = self.last_node
+        else:
+            dirname, _, name = path.rpartition('/')
+            node = self.dir_nodes.get(dirname)
+            if node is None:
+                node = 0
+                for dir_name in dirname.split('/'):
+                    node = self._child(node, dir_name)
+                self.dir_nodes[dirname] = node
+            if path:
+                node = self._child(node, name)
+            self.last_path, self.last_node = path, node
+        return node
+
+    def add(self, path, cmd_ref):
+        ''' Adds command number cmd_ref to path '''
+        node = self._path_node(path)
+        next_refs = self.next_refs
+        if len(next_refs) <= cmd_ref:
+            next_refs.extend(repeat(-1, cmd_ref + 1 - len(next_refs)))
+        last = self.last_refs[node]
+        if last < 0:
+            self.first_refs[node] = cmd_ref
+            self.nodes.append(node)
+        else:
+            next_refs[last] = cmd_ref
+        self.last_refs[node] = cmd_ref
+
+    def add_refs(self, path, cmd_refs, first_ref=0):
+        ''' Adds command numbers first_ref + cmd_ref for cmd_ref in cmd_refs
+        (increasing, and above those already added) to path, e.g. when
+        merging commands decoded separately '''
+        node = self._path_node(path)
+        next_refs = self.next_refs
+        end = first_ref + cmd_refs[-1] + 1
+        if len(next_refs) < end:
+            next_refs.extend(repeat(-1, end - len(next_refs)))
+        ref = first_ref + cmd_refs[0]
+        last = self.last_refs[node]
+        if last < 0:
+            self.first_refs[node] = ref
+            self.nodes.append(node)
+        else:
+            next_refs[last] = ref
+        for cmd_ref in cmd_refs[1:]:
+            next_refs[ref] = ref = first_ref + cmd_ref
+        self.last_refs[node] = ref
+
+    def path(self, node):
+        ''' Full path of node '''
+        names = []
+        while node:
+            names.append(self.names[node])
+            node = self.parents[node]
+        return '/'.join(reversed(names))
+
+    def refs(self, node):
+        ''' List of command numbers of node '''
+        ref = self.first_refs[node]
+        if ref < 0:
+            return []
+        refs = [ref]
+        last = self.last_refs[node]
+        while ref != last:
+            ref = self.next_refs[ref]
+            refs.append(ref)
+        return refs
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, path):
+        node = self._node(path)
+        return node is not None and self.first_refs[node] >= 0
+
+    def __getitem__(self, path):
+        node = self._node(path)
+        if node is None or self.first_refs[node] < 0:
+            raise KeyError(path)
+        return self.refs(node)
+
+    def __iter__(self):
+        for node in self.nodes:
+            yield self.path(node)
+
+    def items(self):
+        ''' (path, cmd_refs) in first-seen order '''
+        for node in self.nodes:
+            yield self.path(node), self.refs(node)
+
+    def subtree(self, prefix):
+        ''' Returns an OrderedDict path => cmd_refs of prefix and paths
+        below it, in first-seen order '''
+        top = self._node(prefix.strip('/'))
+        nodes = []
+        stack = [top] if top is not None else []
+        while stack:
+            node = stack.pop()
+            if self.first_refs[node] >= 0:
+                nodes.append(node)
+            stack.extend(self.children.get(node, {}).values())
+        # Command numbers grow, so the first one gives first-seen order
+        nodes.sort(key=self.first_refs.__getitem__)
+        return OrderedDict((self.path(node), self.refs(node)) for node in nodes)
+
+    def changed_dirs(self, depth=1):
+        ''' Returns paths at given depth (1 is top level) having changes on
+        them or below them, in first-seen order '''
+        # Every node of the trie exists because of a change on or below it
+        level = [0]
+        for _ in range(depth):
+            level = [
+                child
+                for node in level
+                for child in self.children.get(node, {}).values()
+            ]
+        return [self.path(node) for node in sorted(level)]
+
+
+def current_rss():
+    ''' Resident memory of this process, in bytes, not counting pages of
+    mapped files, such as stream files (peak resident memory where /proc is
+    not available) '''
+    try:
+        with open('/proc/self/statm') as f_statm:
+            _, resident, shared = f_statm.read().split()[:3]
+        return (int(resident) - int(shared)) * sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class SpilledPaths:
+    ''' Commands grouped by path with bounded memory (--max-memory)
+
+    Commands are added in stream order with add(), and buffered. Once the
+    resident memory of the process exceeds max_rss, buffered commands are
+    sorted by path and spilled to a temporary file (a run), and the number
+    of buffered commands is then limited to the number that filled memory.
+    items() merges the runs (k-way merge) to group commands by path, spills
+    groups to a second set of runs sorted by their first command number,
+    and merges those to yield (path, cmd_refs) in first-seen order, like
+    PathIndex.items(). self.commands holds the commands of the last path
+    yielded, so that print_by_paths(spilled, spilled.commands, ...) works.
+    '''
+
+    # Resident memory is checked every check_every commands
+    check_every = 4096
+    # Records are written to runs by batches, each one prefixed by its length
+    # (marshal.load() reads files piece by piece, much slower than loads())
+    batch = 1024
+    s_length = Struct('<Q')
+
+    def __init__(self, max_rss):
+        self.max_rss = max_rss
+        self.max_buffered = None
+        self.buffer = []
+        self.runs = []
+        self.commands = {}
+
+    def _full(self, buffered):
+        ''' True if buffered commands must be spilled '''
+        if self.max_buffered is not None:
+            return buffered >= self.max_buffered
+        if buffered % self.check_every == 0 and current_rss() > self.max_rss:
+            self.max_buffered = buffered
+            return True
+        return False
+
+    def _spill(self, records):
+        ''' Writes sorted records to a new run, returns it '''
+        run = TemporaryFile()
+        for start in range(0, len(records), self.batch):
+            batch = marshal.dumps(records[start : start + self.batch])
+            run.write(self.s_length.pack(len(batch)))
+            run.write(batch)
+        run.seek(0)
+        return run
+
+    def _read(self, run):
+        ''' Yields records of run, and closes (deletes) it '''
+        with run:
+            while True:
+                length = run.read(self.s_length.size)
+                if not length:
+                    return
+                yield from marshal.loads(run.read(*self.s_length.unpack(length)))
+
+    def add(self, path, cmd_ref, command):
+        ''' Adds command number cmd_ref on path '''
+        data = command.get('data')
+        if type(data) is memoryview:
+            # Data is a view on the stream
+            command['data'] = bytes(data)
+        elif type(data) is DataRef:
+            # Can't be marshalled, rebuilt by items()
+            command['data'] = (data.offset, data.length)
+        self.buffer.append((path, cmd_ref, command))
+        if self._full(len(self.buffer)):
+            self.buffer.sort()
+            self.runs.append(self._spill(self.buffer))
+            self.buffer = []
+
+    def items(self):
+        ''' (path, cmd_refs) in first-seen order, can be iterated once '''
+        if self.runs and self.buffer:
+            self.buffer.sort()
+            self.runs.append(self._spill(self.buffer))
+            self.buffer = []
+        self.buffer.sort()
+        runs = [self._read(run) for run in self.runs] + [iter(self.buffer)]
+        self.runs = []
+        self.buffer = []
+
+        # Group by path, records are sorted by (path, cmd_ref)
+        group_runs = []
+        groups = []
+        buffered = 0
+        for path, records in groupby(heapq.merge(*runs), key=itemgetter(0)):
+            commands = [(cmd_ref, command) for _, cmd_ref, command in records]
+            groups.append((commands[0][0], path, commands))
+            buffered += len(commands)
+            if self.max_buffered is not None and buffered >= self.max_buffered:
+                groups.sort()
+                group_runs.append(self._spill(groups))
+                groups = []
+                buffered = 0
+        if group_runs and groups:
+            groups.sort()
+            group_runs.append(self._spill(groups))
+            groups = []
+        groups.sort()
+        runs = [self._read(run) for run in group_runs] + [iter(groups)]
+
+        # Paths in first-seen order, by the first command number of groups
+        for _, path, commands in heapq.merge(*runs):
+            for _, command in commands:
+                if type(command.get('data')) is tuple:
+                    command['data'] = DataRef(*command['data'])
+            self.commands.clear()
+            self.commands.update(commands)
+            yield path, [cmd_ref for cmd_ref, _ in commands]
+
+
+def _column(view, typecode):
+    ''' Array of typecode items (little-endian) over view, without copy on
+    little-endian hosts '''
+    if byteorder == 'big':
+        column = array(typecode, view.tobytes())
+        column.byteswap()
+        return column
+    return view.cast(typecode)
+
+
+def _narrow(column):
+    ''' column (an array of unsigned integers) with the smallest item type
+    that holds its values '''
+    largest = max(column, default=0)
+    for typecode in 'BHIQ':
+        if largest < 1 << 8 * array(typecode).itemsize:
+            return column if typecode == column.typecode else array(typecode, column)
+    return column
+
+
+def _path_key(path):
+    ''' Sort key of paths: a directory, then paths below it, are contiguous '''
+    return path.replace('/', '\0')
+
+
+class DiffArchive:
+    ''' Decoded diff saved in a compact binary file by write_archive()
+
+    The file is memory-mapped, and read only on access: commands can be
+    used like the list of commands returned by BtrfsStream.decode(), and
+    self.paths like its PathIndex (items(), subtree(), lookups by path).
+
+    File format (little-endian): header (magic, format version, number of
+    sections), then (offset, length) of each of the sections: meta (JSON:
+    stream version, command layouts as in CommandStore, item types of
+    integer columns), columns of the CommandStore (strings are a blob with
+    an array of offsets, as objects: a type byte, 0 for None, 1 for bytes
+    and 2 for a DataRef, then the value), then paths: string ids of paths in
+    first-seen order, their command numbers (a refs array with an array of
+    offsets) and path numbers sorted by path, for binary searches. Integer
+    columns use the smallest item type holding their values.
+    '''
+
+    magic = b'btrfs-diff-arch\0'
+    format_version = 1
+    s_header = Struct('<16sII')
+    s_section = Struct('<QQ')
+    s_data_ref = Struct('<QQ')
+    sections = (
+        'meta',
+        'strings',
+        'string_offsets',
+        'floats',
+        'objects',
+        'object_offsets',
+        'cmd_layouts',
+        'cmd_starts',
+        'values',
+        'path_ids',
+        'ref_offsets',
+        'refs',
+        'sorted_paths',
+    )
+    kinds = {'int': int, 'str': str, 'float': float, 'object': object}
+
+    def __init__(self, archive_file):
+        ''' Raises OSError if archive_file can't be read, StreamError if it
+        is not an archive '''
+        with open(archive_file, 'rb') as f_archive:
+            self.data = memoryview(mmap(f_archive.fileno(), 0, access=ACCESS_READ))
+        if len(self.data) < self.s_header.size:
+            raise StreamError('Not a diff archive', 0)
+        magic, version, n_sections = self.s_header.unpack_from(self.data, 0)
+        if magic != self.magic:
+            raise StreamError('Not a diff archive', 0)
+        if version != self.format_version or n_sections != len(self.sections):
+            raise StreamError(f'Unsupported diff archive version {version}', 0)
+
+        views = {}
+        index = self.s_header.size
+        for name in self.sections:
+            offset, length = self.s_section.unpack_from(self.data, index)
+            index += self.s_section.size
+            views[name] = self.data[offset : offset + length]
+
+        meta = json.loads(str(views['meta'], 'utf8'))
+        self.strings = views['strings']
+        self.objects = views['objects']
+        for name, typecode in meta['typecodes'].items():
+            setattr(self, name, _column(views[name], typecode))
+        self.version = meta['version']
+        self.layouts = [
+            (name, tuple((key, self.kinds[kind]) for key, kind in fields))
+            for name, fields in meta['layouts']
+        ]
+        self.paths = ArchivePaths(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        ''' Unmaps the archive '''
+        mapped = self.data.obj
+        self.data.release()
+        try:
+            mapped.close()
+        except BufferError:
+            # Columns still referenced, unmapped once released
+            pass
+
+    def string(self, string_id):
+        ''' String number string_id of the string table '''
+        offsets = self.string_offsets
+        return str(self.strings[offsets[string_id] : offsets[string_id + 1]], 'utf8')
+
+    def _object(self, object_id):
+        offsets = self.object_offsets
+        value = self.objects[offsets[object_id] : offsets[object_id + 1]]
+        # 1st byte tells None from bytes and DataRef
+        if value[0] == 2:
+            return DataRef(*self.s_data_ref.unpack_from(value, 1))
+        return bytes(value[1:]) if value[0] else None
+
+    def __len__(self):
+        return len(self.cmd_layouts)
+
+    def __iter__(self):
+        for i in range(len(self.cmd_layouts)):
+            yield self[i]
+
+    def __getitem__(self, cmd_ref):
+        name, fields = self.layouts[self.cmd_layouts[cmd_ref]]
+        start = self.cmd_starts[cmd_ref]
+        command = {'command': name}
+        for (key, kind), value in zip(fields, self.values[start : start + len(fields)]):
+            if kind is str:
+                value = self.string(value)
+            elif kind is float:
+                value = self.floats[value]
+            elif kind is object:
+                value = self._object(value)
+            command[key] = value
+        return command
+
+
+class ArchivePaths:
+    ''' Paths of a DiffArchive, read from the archive on access, with the
+    same interface as PathIndex '''
+
+    def __init__(self, archive):
+        self.archive = archive
+
+    def path(self, index):
+        ''' Path number index, in first-seen order '''
+        return self.archive.string(self.archive.path_ids[index])
+
+    def refs(self, index):
+        ''' List of command numbers of path number index '''
+        offsets = self.archive.ref_offsets
+        return self.archive.refs[offsets[index] : offsets[index + 1]].tolist()
+
+    def _bisect(self, key):
+        ''' First position in sorted paths whose key is not lower than key '''
+        sorted_paths = self.archive.sorted_paths
+        low, high = 0, len(sorted_paths)
+        while low < high:
+            middle = (low + high) // 2
+            if _path_key(self.path(sorted_paths[middle])) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _index(self, path):
+        ''' Path number of path, None if not in archive '''
+        position = self._bisect(_path_key(path))
+        sorted_paths = self.archive.sorted_paths
+        if position < len(sorted_paths) and self.path(sorted_paths[position]) == path:
+            return sorted_paths[position]
+        return None
+
+    def __len__(self):
+        return len(self.archive.path_ids)
+
+    def __contains__(self, path):
+        return self._index(path) is not None
+
+    def __getitem__(self, path):
+        index = self._index(path)
+        if index is None:
+            raise KeyError(path)
+        return self.refs(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.path(index)
+
+    def items(self):
+        ''' (path, cmd_refs) in first-seen order '''
+        for index in range(len(self)):
+            yield self.path(index), self.refs(index)
+
+    def subtree(self, prefix):
+        ''' Returns an OrderedDict path => cmd_refs of prefix and paths
+        below it, in first-seen order '''
+        prefix = prefix.strip('/')
+        if prefix:
+            key = _path_key(prefix)
+            # Below prefix: keys starting with key + '\0'
+            start, stop = self._bisect(key), self._bisect(key + '\1')
+        else:
+            start, stop = 0, len(self)
+        indexes = sorted(self.archive.sorted_paths[start:stop])
+        return OrderedDict((self.path(index), self.refs(index)) for index in indexes)
+
+
+def write_archive(archive_file, commands, paths, version):
+    ''' Saves decoded commands (a list or CommandStore) and paths (a
+    PathIndex or OrderedDict path => cmd_refs) of a stream of given
+    version in archive_file, see DiffArchive '''
+    if not isinstance(commands, CommandStore):
+        store = CommandStore()
+        for command in commands:
+            store.append(command)
+        commands = store
+
+    # Paths are added to the string table of commands
+    strings = list(commands.strings)
+    string_ids = dict(commands.string_ids)
+    path_ids = array('Q')
+    ref_offsets = array('Q', [0])
+    refs = array('Q')
+    keys = []
+    for path, cmd_refs in paths.items():
+        string_id = string_ids.get(path)
+        if string_id is None:
+            string_id = string_ids[path] = len(strings)
+            strings.append(path)
+        path_ids.append(string_id)
+        refs.extend(cmd_refs)
+        ref_offsets.append(len(refs))
+        keys.append(_path_key(path))
+    sorted_paths = array('Q', sorted(range(len(keys)), key=keys.__getitem__))
+
+    encoded = [string.encode('utf8') for string in strings]
+    string_offsets = array('Q', [0])
+    for string in encoded:
+        string_offsets.append(string_offsets[-1] + len(string))
+    objects = [
+        b'\0'
+        if value is None
+        else b'\2' + DiffArchive.s_data_ref.pack(value.offset, value.length)
+        if isinstance(value, DataRef)
+        else b'\1' + bytes(value)
+        for value in commands.objects
+    ]
+    object_offsets = array('Q', [0])
+    for value in objects:
+        object_offsets.append(object_offsets[-1] + len(value))
+
+    columns = {
+        'string_offsets': _narrow(string_offsets),
+        'floats': commands.floats,
+        'object_offsets': _narrow(object_offsets),
+        'cmd_layouts': _narrow(commands.cmd_layouts),
+        'cmd_starts': _narrow(commands.cmd_starts),
+        'values': _narrow(commands.values),
+        'path_ids': _narrow(path_ids),
+        'ref_offsets': _narrow(ref_offsets),
+        'refs': _narrow(refs),
+        'sorted_paths': _narrow(sorted_paths),
+    }
+    kind_names = {kind: name for name, kind in DiffArchive.kinds.items()}
+    meta = {
+        'version': version,
+        'layouts': [
+            [name, [[key, kind_names[kind]] for key, kind in fields]]
+            for name, fields in commands.layouts
+        ],
+        'typecodes': {name: column.typecode for name, column in columns.items()},
+    }
+    columns['meta'] = json.dumps(meta).encode('utf8')
+    columns['strings'] = b''.join(encoded)
+    columns['objects'] = b''.join(objects)
+
+    # Sections are aligned on 8 bytes, after the header and sections table
+    offset = DiffArchive.s_header.size + DiffArchive.s_section.size * len(columns)
+    table = []
+    blobs = []
+    for name in DiffArchive.sections:
+        column = columns[name]
+        if isinstance(column, array):
+            if byteorder == 'big':
+                column = array(column.typecode, column)
+                column.byteswap()
+            column = column.tobytes()
+        padding = -offset % 8
+        blobs.append(bytes(padding))
+        blobs.append(column)
+        offset += padding
+        table.append(DiffArchive.s_section.pack(offset, len(column)))
+        offset += len(column)
+
+    with open(archive_file, 'wb') as f_archive:
+        f_archive.write(
+            DiffArchive.s_header.pack(
+                DiffArchive.magic, DiffArchive.format_version, len(table)
+            )
+        )
+        f_archive.writelines(table)
+        f_archive.writelines(blobs)
+
+
+re_orphan = re.compile(r'o(\d+)-(\d+)-\d+')
+
+
+def orphan_inode(path):
+    ''' Inode number of a temporary name given by btrfs send to new or
+    moved inodes ('o<inode>-<generation>-<index>'), None for other paths
+    '''
+    match = re_orphan.fullmatch(path, path.rfind('/') + 1)
+    return None if match is None else int(match.group(1))
+
+
+class _NetEntry:
+    ''' State of a live inode name: its path in the parent snapshot (None
+    when created by the diff), inode number if known, whether it was
+    modified, and the deleted parent path it took the place of '''
+
+    __slots__ = ('origin', 'inode', 'modified', 'replaced')
+
+    def __init__(self, origin, inode=None):
+        self.origin = origin
+        self.inode = inode
+        self.modified = False
+        self.replaced = None
+
+
+class NetChanges:
+    ''' Net changes of a diff, resolved in one pass over decoded commands
+
+    Commands are fed with add(), as yielded by BtrfsStream.iter_decode().
+    Each name touched by the stream is followed from its path in the parent
+    snapshot to its final path, through rename chains and temporary names,
+    so that state only depends on the number of live names: created then
+    deleted names are forgotten, directory renames carry their descendants.
+    Iterating gives one dict per final path: change (created, rewritten,
+    modified, moved or deleted), path, from (for moved) and inode (if known
+    from temporary names or creation commands).
+    '''
+
+    # Commands creating a new name
+    creations = ('mkfile', 'mkdir', 'mknod', 'mkfifo', 'mksock', 'symlink', 'link')
+    # Commands not related to a file system path
+    ignored = ('snapshot', 'subvol', 'renamed_from')
+    # State of live names
+    entry_type = _NetEntry
+
+    def __init__(self):
+        # Final path => _NetEntry
+        self.live = {}
+        # Deleted path of parent snapshot => inode
+        self.gone = {}
+        # Directory => names of live paths below it, to move them along
+        self.below = {}
+
+    def add(self, path, command):
+        ''' Applies a decoded command on path '''
+        name = command['command']
+        if path is None or name in self.ignored:
+            return
+
+        if name == 'rename':
+            self._rename(path, command['path_to'])
+
+        elif name in ('unlink', 'rmdir'):
+            self._remove(path)
+
+        elif name in self.creations:
+            if name == 'link':
+                target = self.live.get(command['path_link'])
+                inode = target.inode if target is not None else None
+            else:
+                inode = command.get('ino', command.get('inode'))
+            if path in self.live:
+                self._remove(path)
+            self._place(path, self.entry_type(None, inode or orphan_inode(path)))
+
+        else:
+            entry = self.live.get(path)
+            if entry is None:
+                entry = self.entry_type(self._origin(path), orphan_inode(path))
+                self.live[path] = entry
+                self._register(path)
+            entry.modified = True
+
+    def _origin(self, path):
+        ''' Parent snapshot path of path, from its moved or created
+        ancestors; None if it is below a created directory '''
+        head, tail = path, ''
+        while head:
+            head, _, name = head.rpartition('/')
+            tail = f'{name}/{tail}' if tail else name
+            entry = self.live.get(head) if head else None
+            if entry is not None:
+                if entry.origin is None:
+                    return None
+                return f'{entry.origin}/{tail}' if entry.origin else tail
+        return path
+
+    def _register(self, path):
+        ''' Records path in the names below its ancestors '''
+        while path:
+            head, _, name = path.rpartition('/')
+            names = self.below.get(head)
+            if names is not None:
+                names.add(name)
+                return
+            self.below[head] = {name}
+            path = head
+
+    def _unregister(self, path):
+        ''' Forgets path, and its ancestors left without live paths '''
+        while path and path not in self.live and path not in self.below:
+            head, _, name = path.rpartition('/')
+            names = self.below.get(head)
+            if names is None:
+                return
+            names.discard(name)
+            if names:
+                return
+            del self.below[head]
+            path = head
+
+    def _place(self, path, entry):
+        ''' Puts entry at path, which may take the place of a deleted one '''
+        origin = self._origin(path)
+        if origin is not None and origin in self.gone:
+            del self.gone[origin]
+            entry.replaced = origin
+        self.live[path] = entry
+        self._register(path)
+
+    def _release(self, entry):
+        ''' entry leaves its path: the path it replaced is deleted again '''
+        if entry.replaced is not None:
+            self.gone[entry.replaced] = None
+            entry.replaced = None
+
+    def _remove(self, path):
+        entry = self.live.pop(path, None)
+        if entry is None:
+            origin, inode = self._origin(path), orphan_inode(path)
+        else:
+            self._release(entry)
+            origin, inode = entry.origin, entry.inode
+        if origin is not None:
+            self.gone[origin] = inode
+        self._unregister(path)
+
+    def _rename(self, path, path_to):
+        if path_to in self.live:
+            self._remove(path_to)
+        entry = self.live.pop(path, None)
+        if entry is None:
+            entry = self.entry_type(self._origin(path), orphan_inode(path))
+        else:
+            self._release(entry)
+        if entry.inode is None:
+            entry.inode = orphan_inode(path_to)
+
+        # Live paths below a renamed directory follow it
+        moves = [(path, path_to)]
+        for src, dst in moves:
+            names = self.below.pop(src, None)
+            if names is not None:
+                self.below[dst] = names
+                for name in names:
+                    child = self.live.pop(f'{src}/{name}', None)
+                    if child is not None:
+                        self.live[f'{dst}/{name}'] = child
+                    moves.append((f'{src}/{name}', f'{dst}/{name}'))
+
+        self._unregister(path)
+        self._place(path_to, entry)
+
+    def _change(self, path, entry):
+        ''' Net change of a live entry, None if it is unchanged '''
+        if entry.origin is None:
+            change = 'rewritten' if entry.replaced is not None else 'created'
+        elif entry.origin != self._origin(path):
+            return {
+                'change': 'moved',
+                'path': path,
+                'from': entry.origin,
+                'inode': entry.inode,
+            }
+        elif entry.modified:
+            change = 'modified'
+        else:
+            return None
+        return {'change': change, 'path': path, 'from': None, 'inode': entry.inode}
+
+    def get(self, path):
+        ''' Net change of final path, None if it is unchanged '''
+        entry = self.live.get(path)
+        return None if entry is None else self._change(path, entry)
+
+    def temporary(self, path):
+        ''' True for a temporary name which is not a final path '''
+        return path not in self.live and orphan_inode(path) is not None
+
+    def __iter__(self):
+        for path, entry in self.live.items():
+            change = self._change(path, entry)
+            if change is not None:
+                yield change
+        for path, inode in self.gone.items():
+            yield {'change': 'deleted', 'path': path, 'from': None, 'inode': inode}
+
+
+class InodeIndex:
+    ''' Commands of a diff by inode, built as the stream is decoded
+
+    Commands are fed with add(), e.g. by BtrfsStream.decode(inodes=...).
+    Names are followed from the inode numbers known to the stream:
+    temporary names ('o<inode>-<generation>-<index>'), INO attributes of
+    creation commands and targets of links, through renames (with
+    NetChanges), so that all names of a hard-linked inode are found.
+    Lookups are by inode number: index[inode] gives {generation: [(path,
+    cmd_ref), ...]}, in stream order (generation is None until a temporary
+    name gives it). Commands on paths of unknown inodes (not created nor
+    renamed by the stream) are kept by path in self.unknown.
+    '''
+
+    def __init__(self):
+        # Live names => inode
+        self.names = NetChanges()
+        # Inode => generation, from its last temporary name
+        self.generations = {}
+        # Inode => {generation: [(path, cmd_ref), ...]}
+        self.inodes = {}
+        # Path => [cmd_ref, ...], for commands on unknown inodes
+        self.unknown = OrderedDict()
+
+    def _inode(self, path):
+        ''' Inode of live name path, None if unknown '''
+        match = re_orphan.fullmatch(path, path.rfind('/') + 1)
+        if match is not None:
+            inode = int(match.group(1))
+            self.generations[inode] = int(match.group(2))
+            return inode
+        entry = self.names.live.get(path)
+        return None if entry is None else entry.inode
+
+    def add(self, path, cmd_ref, command):
+        ''' Indexes command number cmd_ref, decoded on path '''
+        if path is None:
+            return
+        name = command['command']
+        # Names are removed by unlink, rename moves them
+        inode = self._inode(path)
+        self.names.add(path, command)
+        if inode is None:
+            if name == 'rename':
+                inode = self._inode(command['path_to'])
+            elif name not in ('unlink', 'rmdir'):
+                inode = self._inode(path)
+
+        if inode is None:
+            refs = self.unknown.get(path)
+            if refs is None:
+                self.unknown[path] = [cmd_ref]
+            else:
+                refs.append(cmd_ref)
+            return
+        generations = self.inodes.get(inode)
+        if generations is None:
+            generations = self.inodes[inode] = {}
+        refs = generations.get(self.generations.get(inode))
+        if refs is None:
+            refs = generations[self.generations.get(inode)] = []
+        refs.append((path, cmd_ref))
+
+    def __getitem__(self, inode):
+        return self.inodes[inode]
+
+    def __contains__(self, inode):
+        return inode in self.inodes
+
+    def __len__(self):
+        return len(self.inodes)
+
+    def items(self):
+        ''' (inode, {generation: [(path, cmd_ref), ...]}), in first-seen order '''
+        return self.inodes.items()
+
+    def paths(self, inode):
+        ''' Distinct paths of the commands on inode, in first-seen order,
+        temporary names excepted '''
+        paths = dict.fromkeys(
+            path
+            for refs in self.inodes.get(inode, {}).values()
+            for path, _ in refs
+            if orphan_inode(path) is None
+        )
+        return list(paths)
+
+
+class ByteRanges:
+    ''' Set of byte ranges [start, end), kept sorted and merged, so that
+    its size only depends on the number of disjoint ranges. Ranges are
+    sorted lists searched with bisect rather than an interval tree: adding
+    a range before the last one is O(n) in the number of disjoint ranges,
+    which stays small for the writes of a file '''
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def add(self, start, end):
+        ''' Adds range [start, end) '''
+        starts, ends = self.starts, self.ends
+        if end <= start:
+            return
+        if not ends or start > ends[-1]:
+            # Sequential writes: new range at the end
+            starts.append(start)
+            ends.append(end)
+            return
+        if start >= starts[-1]:
+            # Extends the last range
+            if end > ends[-1]:
+                ends[-1] = end
+            return
+        # Ranges overlapping or touching [start, end) are i .. j - 1
+        i = bisect_left(ends, start)
+        j = bisect_right(starts, end)
+        if i < j:
+            start = min(start, starts[i])
+            end = max(end, ends[j - 1])
+        starts[i:j] = [start]
+        ends[i:j] = [end]
+
+    def truncate(self, size):
+        ''' Drops bytes from size '''
+        i = bisect_left(self.starts, size)
+        del self.starts[i:]
+        del self.ends[i:]
+        if self.ends and self.ends[-1] > size:
+            self.ends[-1] = size
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return zip(self.starts, self.ends)
+
+    @property
+    def size(self):
+        ''' Number of bytes in ranges '''
+        return sum(self.ends) - sum(self.starts)
+
+
+class ChangedExtents:
+    ''' Changed byte ranges of files, built as the stream is decoded
+
+    Commands are fed with add(), as yielded by BtrfsStream.iter_decode().
+    Ranges of update_extent, write, encoded_write (unencoded file range),
+    fallocate and clone commands are merged per file in a ByteRanges,
+    truncate drops ranges beyond the new size. Iterating gives one dict per
+    file (changed ranges and bytes), in first changed order, then one per
+    directory (changed bytes and files below it). Files below a renamed
+    directory follow it, files below a deleted one are dropped.
+    '''
+
+    def __init__(self):
+        # Path => ByteRanges
+        self.files = {}
+        # Directory => names below it leading to files, to rename them along
+        self.below = {}
+
+    def _register(self, path):
+        ''' Records path in the names below its ancestors '''
+        while path:
+            head, _, name = path.rpartition('/')
+            names = self.below.get(head)
+            if names is not None:
+                names.add(name)
+                return
+            self.below[head] = {name}
+            path = head
+
+    def _unregister(self, path):
+        ''' Removes path from the names below its ancestors, and ancestors
+        left without names '''
+        while path:
+            head, _, name = path.rpartition('/')
+            names = self.below.get(head)
+            if names is None:
+                return
+            names.discard(name)
+            if names:
+                return
+            del self.below[head]
+            path = head
+
+    def _rename(self, path, path_to):
+        ''' Moves ranges of path, and of files below it, to path_to '''
+        moves = [(path, path_to)]
+        for src, dst in moves:
+            ranges = self.files.pop(src, None)
+            if ranges is not None:
+                self.files[dst] = ranges
+            names = self.below.pop(src, None)
+            if names is not None:
+                self.below[dst] = names
+                moves.extend((f'{src}/{name}', f'{dst}/{name}') for name in names)
+        self._unregister(path)
+        self._register(path_to)
+
+    def _delete(self, path):
+        ''' Drops ranges of path, and of files below it '''
+        paths = [path]
+        for deleted in paths:
+            self.files.pop(deleted, None)
+            names = self.below.pop(deleted, None)
+            if names is not None:
+                paths.extend(f'{deleted}/{name}' for name in names)
+        self._unregister(path)
+
+    def add(self, path, command):
+        ''' Accounts a decoded command on path '''
+        name = command['command']
+        if name == 'update_extent':
+            offset, size = command['file_offset'], command['size']
+        elif name == 'write':
+            offset, size = command['file_offset'], len(command['data'])
+        elif name == 'encoded_write':
+            offset, size = command['file_offset'], command['unencoded_file_len']
+        elif name in ('clone', 'fallocate'):
+            offset = command['file_offset']
+            size = command['clone_len' if name == 'clone' else 'size']
+        elif name == 'truncate':
+            ranges = self.files.get(path)
+            if ranges is not None:
+                ranges.truncate(command['to_size'])
+            return
+        elif name == 'rename':
+            if path in self.files or path in self.below:
+                self._rename(path, command['path_to'])
+            return
+        elif name in ('unlink', 'rmdir'):
+            if path in self.files or path in self.below:
+                self._delete(path)
+            return
+        else:
+            return
+
+        ranges = self.files.get(path)
+        if ranges is None:
+            ranges = self.files[path] = ByteRanges()
+            self._register(path)
+        ranges.add(offset, offset + size)
+
+    def directories(self):
+        ''' Directory => [changed bytes, changed files] below it '''
+        dirs = {}
+        for path, ranges in self.files.items():
+            size = ranges.size
+            while path:
+                path = path.rpartition('/')[0]
+                totals = dirs.get(path)
+                if totals is None:
+                    totals = dirs[path] = [0, 0]
+                totals[0] += size
+                totals[1] += 1
+        return dirs
+
+    def __iter__(self):
+        for path, ranges in self.files.items():
+            yield {
+                'type': 'file',
+                'path': path,
+                'bytes': ranges.size,
+                'ranges': [list(byte_range) for byte_range in ranges],
+            }
+        for path, (size, files) in self.directories().items():
+            yield {'type': 'dir', 'path': path, 'bytes': size, 'files': files}
+
+
+class _ChangeEntry(_NetEntry):
+    ''' State of a live inode name of a ChangeSet: also its changed byte
+    ranges (a ByteRanges), last truncated size, and last mode, owner, times
+    and xattrs (name => value, None when removed); None when unchanged '''
+
+    __slots__ = ('ranges', 'size', 'mode', 'owner', 'times', 'xattrs')
+
+    # Commands changing data or metadata of a name
+    updates = {
+        'update_extent',
+        'write',
+        'encoded_write',
+        'clone',
+        'fallocate',
+        'truncate',
+        'chmod',
+        'chown',
+        'utimes',
+        'set_xattr',
+        'remove_xattr',
+    }
+
+    def __init__(self, origin, inode=None):
+        super().__init__(origin, inode)
+        self.ranges = None
+        self.size = None
+        self.mode = None
+        self.owner = None
+        self.times = None
+        self.xattrs = None
+
+    def update(self, command):
+        ''' Applies a decoded command of updates '''
+        name = command['command']
+        if name == 'update_extent':
+            offset, size = command['file_offset'], command['size']
+        elif name == 'write':
+            offset, size = command['file_offset'], len(command['data'])
+        elif name == 'encoded_write':
+            offset, size = command['file_offset'], command['unencoded_file_len']
+        elif name in ('clone', 'fallocate'):
+            offset = command['file_offset']
+            size = command['clone_len' if name == 'clone' else 'size']
+        elif name == 'truncate':
+            self.size = command['to_size']
+            if self.ranges is not None:
+                self.ranges.truncate(self.size)
+            return
+        elif name == 'chmod':
+            self.mode = command['mode']
+            return
+        elif name == 'chown':
+            self.owner = (command['user_id'], command['group_id'])
+            return
+        elif name == 'utimes':
+            self.times = (command['atime'], command['mtime'], command['ctime'])
+            return
+        else:
+            if self.xattrs is None:
+                self.xattrs = {}
+            self.xattrs[command['xattr_name']] = command.get('xattr_data')
+            return
+
+        if self.ranges is None:
+            self.ranges = ByteRanges()
+        self.ranges.add(offset, offset + size)
+
+    def merge(self, later):
+        ''' Applies the changes of later, the same name in a later diff:
+        ranges are truncated to its size then merged, its metadata wins '''
+        self.modified = self.modified or later.modified
+        if later.size is not None:
+            self.size = later.size
+            if self.ranges is not None:
+                self.ranges.truncate(later.size)
+        if later.ranges is not None:
+            if self.ranges is None:
+                self.ranges = ByteRanges()
+            for start, end in later.ranges:
+                self.ranges.add(start, end)
+        if later.mode is not None:
+            self.mode = later.mode
+        if later.owner is not None:
+            self.owner = later.owner
+        if later.times is not None:
+            self.times = later.times
+        if later.xattrs is not None:
+            self.xattrs = {**(self.xattrs or {}), **later.xattrs}
+
+
+class ChangeSet(NetChanges):
+    ''' Net changes of a diff (see NetChanges), with what changed on each
+    final path: changed byte ranges (as ChangedExtents), last truncated
+    size, and last mode, owner, times and xattrs
+
+    Change sets of consecutive diffs A -> B and B -> C are composed into
+    the change set of A -> C by compose_changes(), without running btrfs
+    send again. Iterating gives the dicts of NetChanges, with keys size,
+    ranges, mode, owner, times, xattrs (None when unchanged) and replaced
+    (deleted path taken by a new name) for live paths; this list (e.g.
+    saved as JSON) is read back by from_records().
+    '''
+
+    entry_type = _ChangeEntry
+
+    def add(self, path, command):
+        ''' Applies a decoded command on path '''
+        super().add(path, command)
+        if path is not None and command['command'] in _ChangeEntry.updates:
+            self.live[path].update(command)
+
+    @classmethod
+    def from_stream(cls, stream):
+        ''' Change set of a BtrfsStream '''
+        changes = cls()
+        for path, command in stream.iter_decode(bogus=False):
+            changes.add(path, command)
+        return changes
+
+    @classmethod
+    def from_records(cls, records):
+        ''' Change set from the dicts of its iteration, binary xattr values
+        may be hex strings (JSON output) '''
+        changes = cls()
+        implied = []
+        for record in records:
+            path, change = record['path'], record['change']
+            if change == 'deleted':
+                changes.gone[path] = record['inode']
+                continue
+            entry = _ChangeEntry(record['from'], record['inode'])
+            entry.replaced = record.get('replaced')
+            if record.get('ranges') is not None:
+                entry.ranges = ByteRanges()
+                for start, end in record['ranges']:
+                    entry.ranges.add(start, end)
+            entry.size = record.get('size')
+            entry.mode = record.get('mode')
+            if record.get('owner') is not None:
+                entry.owner = tuple(record['owner'])
+            if record.get('times') is not None:
+                entry.times = tuple(record['times'])
+            if record.get('xattrs') is not None:
+                entry.xattrs = {
+                    name: bytes.fromhex(value) if isinstance(value, str) else value
+                    for name, value in record['xattrs'].items()
+                }
+            entry.modified = change == 'modified' or any(
+                getattr(entry, key) is not None for key in _ChangeEntry.__slots__
+            )
+            if change == 'modified':
+                implied.append((path, entry))
+            changes.live[path] = entry
+
+        # Origins of modified paths are implied by their ancestors, which
+        # are resolved first
+        implied.sort(key=lambda item: item[0].count('/'))
+        for path, entry in implied:
+            entry.origin = changes._origin(path)
+        for path in changes.live:
+            changes._register(path)
+        return changes
+
+    def _change(self, path, entry):
+        change = super()._change(path, entry)
+        if change is not None:
+            ranges = entry.ranges
+            change['size'] = entry.size
+            change['ranges'] = None if ranges is None else [list(r) for r in ranges]
+            change['mode'] = entry.mode
+            change['owner'] = None if entry.owner is None else list(entry.owner)
+            change['times'] = None if entry.times is None else list(entry.times)
+            change['xattrs'] = entry.xattrs
+            change['replaced'] = entry.replaced
+        return change
+
+
+def compose_changes(first, second):
+    ''' ChangeSet of A -> C from the ChangeSets of consecutive diffs A -> B
+    (first) and B -> C (second), which are not modified
+
+    Names of C are followed to their origin in B, then in A; names created
+    by first and deleted by second are dropped, byte ranges are merged and
+    metadata of second wins. Each name of both change sets is handled once
+    (walking up its ancestors), so time is linear in their sizes.
+    '''
+    result = ChangeSet()
+    result.gone.update(first.gone)
+    # Names of first followed by second
+    followed = set()
+    # Names created or moved by second, which may replace deleted paths
+    placed = []
+
+    def follow(path):
+        ''' Origin in A, inode and replaced path of A of name path of B '''
+        earlier = first.live.get(path)
+        if earlier is None:
+            return first._origin(path), None, None
+        followed.add(path)
+        return earlier.origin, earlier.inode, earlier.replaced
+
+    for path, later in second.live.items():
+        earlier = None
+        origin = later.origin
+        if origin is not None:
+            earlier = first.live.get(origin)
+            origin = follow(origin)[0]
+
+        inode = later.inode
+        if inode is None and earlier is not None:
+            inode = earlier.inode
+        entry = _ChangeEntry(origin, inode)
+        if earlier is not None:
+            entry.merge(earlier)
+        entry.merge(later)
+        result.live[path] = entry
+
+        if later.origin is not None and later.origin == second._origin(path):
+            # Not moved by second: keeps the path it replaced, if any
+            entry.replaced = earlier.replaced if earlier is not None else None
+            continue
+        if earlier is not None and earlier.replaced is not None:
+            result.gone[earlier.replaced] = None
+        # Paths of A deleted just before the name was placed by second
+        deleted = ()
+        if later.replaced is not None:
+            origin, deleted_inode, replaced = follow(later.replaced)
+            deleted = (origin, replaced)
+            if replaced is not None:
+                result.gone[replaced] = None
+            if origin is not None:
+                result.gone[origin] = deleted_inode
+        placed.append((path, deleted))
+
+    for path, inode in second.gone.items():
+        origin, earlier_inode, replaced = follow(path)
+        if replaced is not None:
+            result.gone[replaced] = None
+        if origin is not None:
+            result.gone[origin] = inode if earlier_inode is None else earlier_inode
+
+    # Names of first not changed by second, moved along their directory
+    moved = {
+        entry.origin: path
+        for path, entry in second.live.items()
+        if entry.origin is not None and entry.origin != path
+    }
+    for path, earlier in first.live.items():
+        if path in followed:
+            continue
+        entry = _ChangeEntry(earlier.origin, earlier.inode)
+        entry.merge(earlier)
+        entry.replaced = earlier.replaced
+        head, tail = path, ''
+        while head:
+            head, _, name = head.rpartition('/')
+            tail = f'{name}/{tail}' if tail else name
+            if head in moved:
+                path = f'{moved[head]}/{tail}'
+                break
+        result.live[path] = entry
+
+    # Names placed by second, where a path of A was deleted before
+    for path, deleted in placed:
+        origin = result._origin(path)
+        if origin in result.gone and (origin in first.gone or origin in deleted):
+            del result.gone[origin]
+            result.live[path].replaced = origin
+    for path in result.live:
+        result._register(path)
+    return result
+
+
+class WriteDigests:
+    ''' Accounting of file data (write and encoded_write commands), as the
+    stream is decoded
+
+    Commands are fed with add(), as yielded by BtrfsStream.iter_decode().
+    Data is hashed and counted per file, and never kept: for each path, the
+    hash of written (offset, data) in stream order, the number of written
+    bytes and the distinct ranges written. Encoded writes are hashed as
+    sent (encoding attributes and encoded data, not decompressed) and
+    count their unencoded file range. Iterating gives one dict per file, in
+    first written order.
+    '''
+
+    hash_name = 'sha256'
+    encoding_attrs = (
+        'unencoded_file_len',
+        'unencoded_len',
+        'unencoded_offset',
+        'compression',
+        'encryption',
+    )
+
+    def __init__(self):
+        # Path => [hash, written bytes, ByteRanges]
+        self.files = {}
+
+    def add(self, path, command):
+        ''' Accounts a decoded command on path '''
+        name = command['command']
+        if name in ('write', 'encoded_write'):
+            data = command['data']
+            offset = command['file_offset']
+            state = self.files.get(path)
+            if state is None:
+                state = self.files[path] = [
+                    hashlib.new(self.hash_name),
+                    0,
+                    ByteRanges(),
+                ]
+            state[0].update(s_u64.pack(offset))
+            if name == 'write':
+                size = len(data)
+            else:
+                size = command['unencoded_file_len']
+                for attr in self.encoding_attrs:
+                    state[0].update(s_u64.pack(command[attr] or 0))
+            state[0].update(data)
+            state[1] += size
+            state[2].add(offset, offset + size)
+
+        elif name == 'rename' and path in self.files:
+            # Data is mostly written after renaming, but follow renamed files
+            self.files[command['path_to']] = self.files.pop(path)
+
+    def __iter__(self):
+        for path, (digest, written, ranges) in self.files.items():
+            yield {
+                'path': path,
+                'written': written,
+                'distinct': ranges.size,
+                'ranges': len(ranges),
+                self.hash_name: digest.hexdigest(),
+            }
+
+
+class DirectorySummary:
+    ''' Counters of changes by directory, down to depth levels, as the
+    stream is decoded
+
+    Commands are fed with add(), as yielded by BtrfsStream.iter_decode().
+    Changes are accounted in the directory containing the changed path,
+    truncated to depth components ('' is the subvolume root): created
+    (including hard links), deleted and renamed paths, modifications
+    (commands changing content or metadata, except times: a file written
+    twice counts 2) and changed bytes (update_extent, write, encoded_write,
+    fallocate and clone, summed even when extents overlap). Temporary names
+    are resolved, e.g. a file created under a temporary name is accounted
+    where it is renamed to. Memory depends on the number of directories at
+    depth and of temporary names in use, not on the number of commands or
+    paths.
+    Iterating gives one dict per directory, sorted by directory.
+    '''
+
+    counters = ('created', 'deleted', 'renamed', 'modifications', 'bytes')
+    created_cmds = {'mkfile', 'mkdir', 'mknod', 'mkfifo', 'mksock', 'symlink', 'link'}
+    deleted_cmds = {'unlink', 'rmdir'}
+    modified_cmds = {
+        'write',
+        'encoded_write',
+        'clone',
+        'fallocate',
+        'update_extent',
+        'truncate',
+        'chmod',
+        'chown',
+        'set_xattr',
+        'remove_xattr',
+        'fileattr',
+        'enable_verity',
+    }
+    accounted_cmds = created_cmds | deleted_cmds | modified_cmds
+
+    def __init__(self, depth=1, path_filter=None):
+        self.depth = depth
+        self.path_filter = path_filter
+        # Directory => counters
+        self.dirs = {}
+        # Temporary name => original path, None if created under this name
+        self.temporary = {}
+        # Temporary name of new inode => counters, until it is renamed
+        self.pending = {}
+
+    def _resolve(self, path):
+        ''' Path with its temporary name replaced by the original path, None
+        for a new inode not renamed yet '''
+        name, sep, below = path.partition('/')
+        if name not in self.temporary:
+            return path
+        origin = self.temporary[name]
+        return None if origin is None else origin + sep + below
+
+    def _counters(self, path):
+        ''' Counters for path, None if path is not selected '''
+        resolved = self._resolve(path)
+        if resolved is None:
+            return self.pending[path.partition('/')[0]]
+        if self.path_filter is not None and not self.path_filter(resolved):
+            return None
+        directory = '/'.join(resolved.split('/')[:-1][: self.depth])
+        counters = self.dirs.get(directory)
+        if counters is None:
+            counters = self.dirs[directory] = [0] * len(self.counters)
+        return counters
+
+    def add(self, path, command):
+        ''' Accounts a decoded command on path '''
+        name = command['command']
+        if name == 'rename':
+            self._rename(path, command['path_to'])
+            return
+        if name not in self.accounted_cmds:
+            return
+
+        if name in self.created_cmds and name != 'link' and re_orphan.fullmatch(path):
+            # New inode, accounted when renamed to its final name
+            self.temporary[path] = None
+            self.pending[path] = [1, 0, 0, 0, 0]
+            return
+
+        counters = self._counters(path)
+        if counters is None:
+            return
+        if name in self.created_cmds:
+            counters[0] += 1
+        elif name in self.deleted_cmds:
+            counters[1] += 1
+            if path in self.temporary:
+                del self.temporary[path]
+                self.pending.pop(path, None)
+        elif name in self.modified_cmds:
+            counters[3] += 1
+            if name == 'update_extent':
+                counters[4] += command['size']
+            elif name == 'write':
+                counters[4] += len(command['data'])
+            elif name == 'encoded_write':
+                counters[4] += command['unencoded_file_len']
+            elif name == 'fallocate':
+                counters[4] += command['size']
+            elif name == 'clone':
+                counters[4] += command['clone_len']
+
+    def _rename(self, path, path_to):
+        ''' Accounts the rename of path to path_to, following temporary names '''
+        if re_orphan.fullmatch(path_to):
+            # Moved away to a temporary name (e.g. before deletion or to
+            # free its name): accounted when renamed or deleted
+            self.temporary[path_to] = self._resolve(path)
+            if path in self.pending:
+                self.pending[path_to] = self.pending.pop(path)
+            self.temporary.pop(path, None)
+            return
+
+        counters = self._counters(path_to)
+        if path in self.pending:
+            # New inode gets its name
+            del self.temporary[path]
+            pending = self.pending.pop(path)
+            if counters is not None:
+                for index, value in enumerate(pending):
+                    counters[index] += value
+            return
+        self.temporary.pop(path, None)
+        if counters is not None:
+            counters[2] += 1
+
+    def __iter__(self):
+        for directory in sorted(self.dirs):
+            yield {
+                'directory': directory,
+                **dict(zip(self.counters, self.dirs[directory])),
+            }
+
+
+def in_subtree(path, prefix):
+    ''' True if path is prefix or below it '''
+    prefix = prefix.strip('/')
+    return prefix == '' or path == prefix or path.startswith(prefix + '/')
+
+
+def path_matcher(subtree=None, globs=None):
+    ''' Returns a function path => bool, selecting paths in subtree (see
+    in_subtree) and matching one of globs (fnmatch patterns, '*' matches
+    '/' too); None if all paths are selected '''
+    if subtree is None and not globs:
+        return None
+    prefix = None if subtree is None else subtree.strip('/')
+    below = f'{prefix}/'
+    patterns = [re.compile(fnmatch.translate(glob)).match for glob in globs or ()]
+
+    def match(path):
+        if prefix and path != prefix and not path.startswith(below):
+            return False
+        return not patterns or any(pattern(path) for pattern in patterns)
+
+    return match
+
+
+@lru_cache(maxsize=1 << 16)
+def _time_str(sec):
+    return time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(sec))
+
+
+def time_str(epoch):
+    ''' Epoch => string
+    1610391575.9802792 => '2021/01/11 08:59:35' '''
+    # Cached by second, as many commands share the same times
+    return _time_str(int(epoch))
+
+
+def format_extents(extents):
+    ''' 'update extents 0 -> 4096, 8192 -> 12288' for merged ByteRanges '''
+    return 'update extents ' + ', '.join(f'{start} -> {end}' for start, end in extents)
+
+
+def format_actions(actions, commands, changes=None):
+    ''' Returns the list of formatted actions for the commands numbers in
+    actions, in a single pass
+    With changes (a NetChanges, used by --filter), renames from temporary
+    names or rename chains are shown as their net change '''
+    filter = changes is not None
+    prev_action = None
+    extents = ByteRanges()
+    print_actions = []
+
+    for action in actions:
+
+        cmd = commands[action]
+        cmd_short = cmd['command']
+
+        if prev_action == 'update_extent' and cmd_short != 'update_extent':
+            print_actions.append(format_extents(extents))
+            extents = ByteRanges()
+
+        if cmd_short == 'renamed_from':
+            change = changes.get(cmd['path_to']) if filter else None
+            if change is None or change['change'] == 'modified':
+                print_actions.append(f'renamed from "{cmd["path"]}"')
+            elif change['change'] == 'moved':
+                print_actions.append(f'moved from "{change["from"]}"')
+            else:
+                # created / rewritten
+                print_actions.append(change['change'])
+
+        elif cmd_short == 'set_xattr':
+            print_actions.append(f'xattr {cmd["xattr_name"]} {cmd["xattr_data"].hex()}')
+
+        elif cmd_short == 'update_extent':
+            extents.add(cmd['file_offset'], cmd['file_offset'] + cmd['size'])
+
+        elif cmd_short == 'truncate':
+            print_actions.append(f'truncate {cmd["to_size"]:d}')
+
+        elif cmd_short == 'chown':
+            print_actions.append(f'owner {cmd["user_id"]}:{cmd["group_id"]}')
+
+        elif cmd_short == 'chmod':
+            print_actions.append(f'mode {cmd["mode"]:o}')
+
+        elif cmd_short == 'link':
+            print_actions.append(f'link to "{cmd["path_link"]}"')
+
+        elif cmd_short == 'symlink':
+            print_actions.append(
+                f'symlink to "{cmd["path_link"]}" (inode {cmd["inode"]})'
+            )
+
+        elif cmd_short in ('unlink', 'mkfile', 'mkdir', 'mkfifo'):
+            print_actions.append(cmd_short)
+
+        elif cmd_short == 'rename':
+            print_actions.append(f'rename to "{cmd["path_to"]}')
+
+        elif cmd_short == 'utimes':
+            if filter and prev_action == 'utimes':
+                # Print only last utimes
+                del print_actions[-1]
+            print_actions.append(
+                f'times a={time_str(cmd["atime"])} '
+                f'm={time_str(cmd["mtime"])} '
+                f'c={time_str(cmd["ctime"])}'
+            )
+
+        elif cmd_short == 'snapshot':
+            print_actions.append(
+                f'snapshot: uuid={cmd["uuid"]}, '
+                f'ctransid={cmd["ctransid"]:d}, '
+                f'clone_uuid={cmd["clone_uuid"]}, '
+                f'clone_ctransid={cmd["clone_ctransid"]:d}'
+            )
+
+        elif cmd_short == 'write':
+            print_actions.append(f'write: from {cmd["file_offset"]:d}')
+            if isinstance(cmd['data'], DataRef):
+                print_actions.append(f'data: {len(cmd["data"])} bytes (not read)')
+            else:
+                # Bytes to string
+                print_actions.append('data: \n' + str(cmd['data'], 'latin-1'))
+
+        elif cmd_short == 'encoded_write':
+            print_actions.append(
+                f'encoded write: from {cmd["file_offset"]:d}, '
+                f'{cmd["unencoded_file_len"]:d} bytes '
+                f'({len(cmd["data"])} encoded, compression {cmd["compression"]})'
+            )
+
+        elif cmd_short == 'fallocate':
+            print_actions.append(
+                f'fallocate {cmd["file_offset"]:d} -> '
+                f'{cmd["file_offset"] + cmd["size"]:d} (mode {cmd["fallocate_mode"]})'
+            )
+
+        elif cmd_short == 'fileattr':
+            print_actions.append(f'fileattr {cmd["fileattr"]:#x}')
+
+        elif cmd_short == 'enable_verity':
+            print_actions.append(
+                f'enable verity: algorithm {cmd["verity_algorithm"]}, '
+                f'block size {cmd["verity_block_size"]}'
+            )
+
+        else:
+            print_actions.append('%s, %s %s' % (action, cmd, '-' * 20))
+        prev_action = cmd_short
+
+    if extents:
+        print_actions.append(format_extents(extents))
+
+    return print_actions
+
+
+def print_by_paths(paths, commands, changes, csv, out=None):
+    ''' Prints actions grouped by path, each path once, to out (stdout by
+    default, through a large buffer)
+    With changes (a NetChanges), temporary paths are not displayed and
+    renames show net changes '''
+
+    if out is None:
+        with open_output() as out:
+            print_by_paths(paths, commands, changes, csv, out)
+        return
+
+    write = out.write
+    sep = ';'
+    esc_sep = '\\' + sep
+
+    for path, actions in paths.items():
+
+        if changes is not None and changes.temporary(path):
+            # Temporary files / dirs / links... created by btrfs send, later
+            # renamed to definitive ones or deleted
+            continue
+
+        if path == '':
+            path = '__sub_root__'
+
+        print_actions = format_actions(actions, commands, changes)
+
+        if csv:
+            write(
+                f'{path.replace(sep, esc_sep)}{sep}'
+                f'{sep.join([a.replace(sep, esc_sep) for a in print_actions])}\n'
+            )
+        else:
+            write(f'\n{path}\n')
+            if print_actions:
+                write('\t' + '\n\t'.join(print_actions) + '\n')
+
+
+def iter_inodes(inodes, commands, match=None):
+    ''' Yields (inode, generation, names, refs) for each inode (an
+    InodeIndex) and generation, refs being its [(path, cmd_ref), ...] in
+    stream order. With match, only inodes having a matching path are
+    yielded '''
+    for inode, generations in inodes.items():
+        for generation, refs in generations.items():
+            # Names in first-seen order, with destinations of renames
+            paths = {}
+            for path, cmd_ref in refs:
+                paths[path] = None
+                if commands[cmd_ref]['command'] == 'rename':
+                    paths[commands[cmd_ref]['path_to']] = None
+            if match is not None and not any(match(path) for path in paths):
+                continue
+            # Temporary names only when the inode has no other name
+            names = [path for path in paths if orphan_inode(path) is None] or list(
+                paths
+            )
+            yield inode, generation, names, refs
+
+
+def inode_objects(inodes, commands, match=None):
+    ''' Yields {inode, generation, names, commands} for each inode and
+    generation (an InodeIndex), then for each path of unknown inodes (inode
+    and generation None), for JSON output '''
+    for inode, generation, names, refs in iter_inodes(inodes, commands, match):
+        yield {
+            'inode': inode,
+            'generation': generation,
+            'names': names,
+            'commands': [commands[cmd_ref] for _, cmd_ref in refs],
+        }
+    for path, refs in inodes.unknown.items():
+        if match is None or match(path):
+            yield {
+                'inode': None,
+                'generation': None,
+                'names': [path],
+                'commands': [commands[cmd_ref] for cmd_ref in refs],
+            }
+
+
+def print_by_inodes(inodes, commands, csv, match=None, out=None):
+    ''' Prints actions grouped by inode (an InodeIndex) and generation, each
+    with its names and each action with the name it applies to, then
+    actions of paths of unknown inodes, to out (stdout by default). With
+    match, only inodes and paths having a matching path are printed '''
+
+    if out is None:
+        with open_output() as out:
+            print_by_inodes(inodes, commands, csv, match, out)
+        return
+
+    write = out.write
+    sep = ';'
+    esc_sep = '\\' + sep
+
+    for inode, generation, names, refs in iter_inodes(inodes, commands, match):
+        if csv:
+            print_actions = format_actions([cmd_ref for _, cmd_ref in refs], commands)
+            write(
+                f'{inode}{sep}{"" if generation is None else generation}{sep}'
+                f'{",".join(names).replace(sep, esc_sep)}{sep}'
+                f'{sep.join([a.replace(sep, esc_sep) for a in print_actions])}\n'
+            )
+            continue
+        title = f'inode {inode}'
+        if generation is not None:
+            title += f' generation {generation}'
+        write(f'\n{title}: {", ".join(names)}\n')
+        # Actions prefixed by the name they apply to, formatted by runs of
+        # commands on the same name (to merge their extents)
+        for path, run in groupby(refs, key=itemgetter(0)):
+            for action in format_actions([cmd_ref for _, cmd_ref in run], commands):
+                write(f'\t{path}: {action}\n')
+
+    unknown = inodes.unknown
+    if match is not None:
+        unknown = OrderedDict(
+            (path, refs) for path, refs in unknown.items() if match(path)
+        )
+    if csv:
+        for path, refs in unknown.items():
+            print_actions = format_actions(refs, commands)
+            write(
+                f'{sep}{sep}{(path or "__sub_root__").replace(sep, esc_sep)}{sep}'
+                f'{sep.join([a.replace(sep, esc_sep) for a in print_actions])}\n'
+            )
+    else:
+        print_by_paths(unknown, commands, None, csv, out)
+
+
+def print_net(changes, csv, out=None):
+    ''' Prints net changes, one path per line, to out (stdout by default) '''
+    if out is None:
+        with open_output() as out:
+            print_net(changes, csv, out)
+        return
+
+    sep = ';'
+    esc_sep = '\\' + sep
+    for change in changes:
+        path = change['path'] or '__sub_root__'
+        origin = change['from']
+        # Changes of a ChangeSet (--compose)
+        details = format_change(change) if 'ranges' in change else ()
+        if csv:
+            out.write(
+                f'{change["change"]}{sep}{path.replace(sep, esc_sep)}{sep}'
+                f'{"" if origin is None else origin.replace(sep, esc_sep)}'
+                + ''.join(f'{sep}{detail.replace(sep, esc_sep)}' for detail in details)
+                + '\n'
+            )
+        else:
+            line = f'{change["change"]}\t{path}'
+            if origin is not None:
+                line += f'\tfrom "{origin}"'
+            out.write(line + ''.join(f'\t{detail}' for detail in details) + '\n')
+
+
+def format_change(change):
+    ''' Formatted changes of a path of a ChangeSet, as by format_actions() '''
+    details = []
+    if change['size'] is not None:
+        details.append(f'truncate {change["size"]:d}')
+    if change['ranges']:
+        details.append(
+            'changed extents '
+            + ', '.join(f'{start} -> {end}' for start, end in change['ranges'])
+        )
+    if change['mode'] is not None:
+        details.append(f'mode {change["mode"]:o}')
+    if change['owner'] is not None:
+        details.append(f'owner {change["owner"][0]}:{change["owner"][1]}')
+    if change['times'] is not None:
+        atime, mtime, ctime = change['times']
+        details.append(
+            f'times a={time_str(atime)} m={time_str(mtime)} c={time_str(ctime)}'
+        )
+    for name, value in (change['xattrs'] or {}).items():
+        details.append(
+            f'xattr {name} removed' if value is None else f'xattr {name} {value.hex()}'
+        )
+    return details
+
+
+def print_extents(extents, csv, out):
+    ''' Prints changed bytes of files and directories, one per line, to out '''
+    sep = ';'
+    esc_sep = '\\' + sep
+    for extent in extents:
+        path = extent['path']
+        if extent['type'] == 'dir':
+            path = f'{path or "__sub_root__"}/'
+            detail = extent['files']
+        else:
+            detail = ' '.join(f'{start}-{end}' for start, end in extent['ranges'])
+        if csv:
+            out.write(
+                f'{extent["type"]}{sep}{path.replace(sep, esc_sep)}{sep}'
+                f'{extent["bytes"]}{sep}{detail}\n'
+            )
+        elif extent['type'] == 'dir':
+            out.write(f'{path}\t{extent["bytes"]} bytes changed in {detail} files\n')
+        else:
+            out.write(f'{path}\t{extent["bytes"]} bytes changed: {detail}\n')
+
+
+def print_summary(dirs, csv, out):
+    ''' Prints change counters of directories, one per line, with a total
+    line, to out '''
+    sep = ';'
+    esc_sep = '\\' + sep
+    counters = DirectorySummary.counters
+    total = dict.fromkeys(counters, 0)
+    if csv:
+        out.write(sep.join(('directory',) + counters) + '\n')
+    else:
+        out.write(f'{"directory":<40}' + ''.join(f'{c:>14}' for c in counters) + '\n')
+    for directory in dirs:
+        for counter in counters:
+            total[counter] += directory[counter]
+        path = directory['directory']
+        if csv:
+            out.write(
+                path.replace(sep, esc_sep)
+                + ''.join(f'{sep}{directory[c]}' for c in counters)
+                + '\n'
+            )
+        else:
+            out.write(
+                f'{path or "__sub_root__":<40}'
+                + ''.join(f'{directory[c]:>14}' for c in counters)
+                + '\n'
+            )
+    if not csv:
+        out.write(
+            f'{"total":<40}' + ''.join(f'{total[c]:>14}' for c in counters) + '\n'
+        )
+
+
+def print_data(files, csv, out):
+    ''' Prints data accounting of written files, one per line, to out '''
+    sep = ';'
+    esc_sep = '\\' + sep
+    for file in files:
+        digest = file[WriteDigests.hash_name]
+        if csv:
+            out.write(
+                f'{file["path"].replace(sep, esc_sep)}{sep}{file["written"]}{sep}'
+                f'{file["distinct"]}{sep}{file["ranges"]}{sep}{digest}\n'
+            )
+        else:
+            out.write(
+                f'{file["path"]}\t{file["written"]} bytes written, '
+                f'{file["distinct"]} distinct in {file["ranges"]} ranges, '
+                f'{WriteDigests.hash_name} {digest}\n'
+            )
+
+
+def print_csv(commands, out=None):
+    ''' One line per command, attributes sorted by name, to out (stdout by
+    default) '''
+    if out is None:
+        with open_output() as out:
+            print_csv(commands, out)
+        return
+
+    write = out.write
+    sep = ';'
+    esc_sep = '\\' + sep
+    for cmd in commands:
+        write(f'{cmd["command"].replace(sep, esc_sep)}')
+        for k in sorted(cmd):
+            if k == 'command':
+                continue
+            v = cmd[k]
+            if isinstance(v, str):
+                v = v.replace(sep, esc_sep)
+            elif isinstance(v, (bytes, memoryview)):
+                v = v.hex()
+            elif isinstance(v, DataRef):
+                v = f'{v.offset}+{v.length}'
+            write(f'{sep}{k}={v}')
+        write('\n')
+
+
+def json_default(value):
+    ''' Binary attributes (xattr data, write data) are encoded in hex, data
+    not read as {"offset": ..., "length": ...} '''
+    if isinstance(value, (bytes, memoryview)):
+        return value.hex()
+    if isinstance(value, DataRef):
+        return {'offset': value.offset, 'length': value.length}
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def write_json(commands, out, pretty=False, lines=False):
+    ''' Writes commands to out as a JSON list, or as NDJSON (one command
+    per line) with lines. Commands are written one by one as they come, so
+    commands can be a generator and is never held in memory.
+    '''
+    encode = json.JSONEncoder(indent=2 if pretty else None, default=json_default).encode
+    if lines:
+        for cmd in commands:
+            out.write(encode(cmd))
+            out.write('\n')
+        return
+
+    sep = ',\n  ' if pretty else ', '
+    first = True
+    for cmd in commands:
+        item = encode(cmd)
+        if pretty:
+            item = item.replace('\n', '\n  ')
+        out.write(('[\n  ' if pretty else '[') if first else sep)
+        out.write(item)
+        first = False
+    if first:
+        out.write('[]\n')
+    else:
+        out.write('\n]\n' if pretty else ']\n')
+
+
+def open_output():
+    ''' Large buffered writer on stdout, for big outputs '''
+    stdout.flush()
+    return open(
+        stdout.fileno(), 'w', buffering=1 << 20, encoding='utf-8', closefd=False
+    )
+
+
+class DiffCache:
+    ''' Directory of send streams, one file per parent / child snapshots
+    pair, named after their UUID and generation (as given by "btrfs
+    subvolume show"), so that a diff between read-only snapshots is only
+    computed once. Files are memory-mapped when read; least recently used
+    ones are deleted when the directory grows above max_size bytes, and
+    streams larger than max_size are not kept.
+    '''
+
+    def __init__(self, directory, max_size, btrfs='btrfs'):
+        self.directory = directory
+        self.max_size = max_size
+        self.btrfs = btrfs
+        makedirs(directory, exist_ok=True)
+
+    def snapshot_id(self, snapshot):
+        ''' "<uuid>-<generation>" of snapshot, None if unknown '''
+        try:
+            show = subprocess.run(
+                [self.btrfs, 'subvolume', 'show', snapshot],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                check=True,
+                universal_newlines=True,
+            )
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        fields = {}
+        for line in show.stdout.splitlines():
+            name, _, value = line.partition(':')
+            fields[name.strip()] = value.strip()
+        if not fields.get('UUID') or not fields.get('Generation'):
+            return None
+        return f'{fields["UUID"]}-{fields["Generation"]}'
+
+    def key(self, parent, child):
+        ''' Cache key of the diff between parent and child, None if a
+        snapshot can't be identified '''
+        parent_id = self.snapshot_id(parent)
+        child_id = self.snapshot_id(child)
+        if parent_id is None or child_id is None:
+            return None
+        return f'{parent_id}_{child_id}'
+
+    def path(self, key):
+        return path_join(self.directory, f'{key}.stream')
+
+    def get(self, key):
+        ''' Path of the cached stream for key, None if not cached '''
+        path = self.path(key)
+        try:
+            # Most recently used
+            utime(path)
+        except OSError:
+            return None
+        return path
+
+    def create(self):
+        ''' New temporary file to write a stream, see store() '''
+        return NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False)
+
+    def store(self, key, f_tmp):
+        ''' Moves the stream written to f_tmp to the cache, then evicts least
+        recently used streams if needed. A stream larger than max_size is
+        deleted instead, returns False then '''
+        f_tmp.close()
+        if lstat(f_tmp.name).st_size > self.max_size:
+            unlink(f_tmp.name)
+            return False
+        path = self.path(key)
+        replace(f_tmp.name, path)
+        self.evict(keep=path)
+        return True
+
+    def evict(self, keep=None):
+        ''' Deletes least recently used streams above max_size bytes, except
+        keep (the path of the stream just stored) '''
+        entries = []
+        total = 0
+        with scandir(self.directory) as dir_entries:
+            for entry in dir_entries:
+                if entry.name.endswith('.stream'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                unlink(path)
+            except OSError:
+                continue
+            total -= size
+
+
+class TeeReader:
+    ''' Binary reader copying all data read from pipe to copy (a named
+    file), until more than limit bytes are read: the copy is then closed
+    and deleted, and self.copy set to None '''
+
+    def __init__(self, pipe, copy, limit=None):
+        self.pipe = pipe
+        self.copy = copy
+        self.limit = limit
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.pipe.read(size)
+        if self.copy is not None:
+            self.size += len(data)
+            if self.limit is not None and self.size > self.limit:
+                self.copy.close()
+                unlink(self.copy.name)
+                self.copy = None
+            else:
+                self.copy.write(data)
+        return data
 
-class BtrfsStream:
-    ''' Btrfs send stream representation
+
+class SnapshotDiff:
+    ''' Send stream between parent and child snapshots, read from cache if
+    available, else from the pipe of a btrfs send process (and stored to
+    cache while being read). stream_file is given to BtrfsStream, close()
+    must be called once decoded.
+    Raises OSError if btrfs can't be executed.
     '''
 
-    # From btrfs/send.h
-    send_cmds = 'BTRFS_SEND_C_UNSPEC BTRFS_SEND_C_SUBVOL BTRFS_SEND_C_SNAPSHOT BTRFS_SEND_C_MKFILE BTRFS_SEND_C_MKDIR BTRFS_SEND_C_MKNOD BTRFS_SEND_C_MKFIFO BTRFS_SEND_C_MKSOCK BTRFS_SEND_C_SYMLINK BTRFS_SEND_C_RENAME BTRFS_SEND_C_LINK BTRFS_SEND_C_UNLINK BTRFS_SEND_C_RMDIR BTRFS_SEND_C_SET_XATTR BTRFS_SEND_C_REMOVE_XATTR BTRFS_SEND_C_WRITE BTRFS_SEND_C_CLONE BTRFS_SEND_C_TRUNCATE BTRFS_SEND_C_CHMOD BTRFS_SEND_C_CHOWN BTRFS_SEND_C_UTIMES BTRFS_SEND_C_END BTRFS_SEND_C_UPDATE_EXTENT'.split()
+    def __init__(
+        self, parent, child, cache=None, refresh=False, with_data=False, btrfs='btrfs'
+    ):
+        self.cmd = self.command(parent, child, with_data, btrfs)
+        self.cache = cache
+        self.send = None
+        self.tee = None
+        # Seconds btrfs send ran
+        self.elapsed = 0.0
+        self.key = None if cache is None else cache.key(parent, child)
+        if self.key is not None and with_data:
+            self.key += '_data'
 
-    send_attrs = 'BTRFS_SEND_A_UNSPEC BTRFS_SEND_A_UUID BTRFS_SEND_A_CTRANSID BTRFS_SEND_A_INO BTRFS_SEND_A_SIZE BTRFS_SEND_A_MODE BTRFS_SEND_A_UID BTRFS_SEND_A_GID BTRFS_SEND_A_RDEV BTRFS_SEND_A_CTIME BTRFS_SEND_A_MTIME BTRFS_SEND_A_ATIME BTRFS_SEND_A_OTIME BTRFS_SEND_A_XATTR_NAME BTRFS_SEND_A_XATTR_DATA BTRFS_SEND_A_PATH BTRFS_SEND_A_PATH_TO BTRFS_SEND_A_PATH_LINK BTRFS_SEND_A_FILE_OFFSET BTRFS_SEND_A_DATA BTRFS_SEND_A_CLONE_UUID BTRFS_SEND_A_CLONE_CTRANSID BTRFS_SEND_A_CLONE_PATH BTRFS_SEND_A_CLONE_OFFSET BTRFS_SEND_A_CLONE_LEN'.split()
+        self.stream_file = None
+        if self.key is not None and not refresh:
+            self.stream_file = cache.get(self.key)
 
-    # From btrfs/ioctl.h:#define BTRFS_UUID_SIZE 16
-    BTRFS_UUID_SIZE = 16
+        if self.stream_file is None:
+            # No -f: the stream is decoded while btrfs send writes it to the pipe
+            self.elapsed = time.perf_counter()
+            self.send = subprocess.Popen(self.cmd, stdout=subprocess.PIPE)
+            self.stream_file = self.send.stdout
+            if self.key is not None:
+                # Copied to the cache, unless it can't fit
+                self.tee = TeeReader(self.send.stdout, cache.create(), cache.max_size)
+                self.stream_file = self.tee
 
-    # Headers length
-    l_head = 10
-    l_tlv = 4
+    @staticmethod
+    def command(parent, child, with_data=False, btrfs='btrfs'):
+        ''' btrfs send command line of the diff '''
+        cmd = [btrfs, 'send', '-p', parent, child, '-q']
+        if not with_data:
+            cmd.insert(4, '--no-data')
+        return cmd
 
-    def __init__(self, stream_file, delete=False):
+    def close(self, decoded=True):
+        ''' Waits for btrfs send, stores the stream to cache if it succeeded
+        and the stream was decoded. Returns False if btrfs send failed '''
+        if self.send is None:
+            return True
+        self.send.stdout.close()
+        success = self.send.wait() == 0
+        self.elapsed = time.perf_counter() - self.elapsed
+        if self.tee is not None and self.tee.copy is not None:
+            if success and decoded:
+                self.cache.store(self.key, self.tee.copy)
+            else:
+                self.tee.copy.close()
+                unlink(self.tee.copy.name)
+        if not success:
+            printerr(f'Error: CalledProcessError\nexecuting "{" ".join(self.cmd)}"\n')
+        return success
 
-        # Read send stream
-        try:
-            with open(stream_file, 'rb') as f_stream:
-                self.stream = f_stream.read()
 
-        except IOError:
-            printerr('Error reading stream\n')
-            exit(1)
+def default_cache_dir():
+    ''' $XDG_CACHE_HOME/btrfs-snapshots-diff, ~/.cache by default '''
+    base = environ.get('XDG_CACHE_HOME') or path_join(expanduser('~'), '.cache')
+    return path_join(base, 'btrfs-snapshots-diff')
 
-        if delete:
-            try:
-                unlink(stream_file)
-            except OSError:
-                printerr('Warning: could not delete stream file "{stream_file}"\n')
 
-        if len(self.stream) < 17:
-            printerr('Invalide stream length\n')
-            self.version = None
+def report_stats(stream, diff, elapsed, args, title=None):
+    ''' Completes stream stats with the time spent in btrfs send (diff, a
+    SnapshotDiff or None) and rendering, then prints them to stderr as text
+    or JSON (--stats json) '''
+    stats = stream.stats
+    times = stats.times
+    times['total'] = elapsed
+    times['render'] = max(0.0, elapsed - times['read'] - times['decode'])
+    if diff is not None:
+        stats.cached = diff.send is None
+        times['send'] = diff.elapsed
 
-        magic, _, self.version = unpack('<12scI', self.stream[0:17])
-        if magic != b'btrfs-stream':
-            printerr('Not a Btrfs stream!\n')
-            self.version = None
-
-    def _tlv_get(self, attr_type, index):
-        attr, l_attr = unpack('<HH', self.stream[index : index + self.l_tlv])
-        if self.send_attrs[attr] != attr_type:
-            raise ValueError(f'Unexpected attribute {self.send_attrs[attr]}')
-        ret = unpack(
-            f'<{l_attr}B', self.stream[index + self.l_tlv : index + self.l_tlv + l_attr]
-        )
-        return index + self.l_tlv + l_attr, ret
-
-    def _tlv_get_string(self, attr_type, index):
-        attr, l_attr = unpack('<HH', self.stream[index : index + self.l_tlv])
-        if self.send_attrs[attr] != attr_type:
-            raise ValueError(f'Unexpected attribute {self.send_attrs[attr]}')
-        (ret,) = unpack(
-            f'<{l_attr}s', self.stream[index + self.l_tlv : index + self.l_tlv + l_attr]
-        )
-        return index + self.l_tlv + l_attr, ret.decode('utf8')
-
-    def _tlv_get_u64(self, attr_type, index):
-        attr, l_attr = unpack('<HH', self.stream[index : index + self.l_tlv])
-        if self.send_attrs[attr] != attr_type:
-            raise ValueError(f'Unexpected attribute {self.send_attrs[attr]}')
-        (ret,) = unpack(
-            '<Q', self.stream[index + self.l_tlv : index + self.l_tlv + l_attr]
-        )
-        return index + self.l_tlv + l_attr, ret
-
-    def _tlv_get_uuid(self, attr_type, index):
-        attr, l_attr = unpack('<HH', self.stream[index : index + self.l_tlv])
-        if self.send_attrs[attr] != attr_type:
-            raise ValueError(f'Unexpected attribute {self.send_attrs[attr]}')
-        ret = unpack(
-            f'<{self.BTRFS_UUID_SIZE}B',
-            self.stream[index + self.l_tlv : index + self.l_tlv + l_attr],
-        )
-        return index + self.l_tlv + l_attr, ''.join(['%02x' % x for x in ret])
-
-    def _tlv_get_timespec(self, attr_type, index):
-        attr, l_attr = unpack('<HH', self.stream[index : index + self.l_tlv])
-        if self.send_attrs[attr] != attr_type:
-            raise ValueError(f'Unexpected attribute {self.send_attrs[attr]}')
-        sec, nanos = unpack(
-            '<QL', self.stream[index + self.l_tlv : index + self.l_tlv + l_attr]
+    if args.stats == 'json':
+        blob = stats.as_dict()
+        if title is not None:
+            blob['diff'] = title
+        printerr(json.dumps(blob) + '\n')
+    else:
+        printerr((f'{title}\n' if title is not None else '') + stats.format())
+
+
+def write_report(stream, args, out):
+    ''' Writes the output selected by command line args (data accounting,
+    net changes, by path, CSV or JSON) for stream to out '''
+
+    # Selected paths: outputs of commands select them while decoding,
+    # other outputs need all commands (e.g. renames) and select results
+    match = path_matcher(args.subtree, args.path)
+    select = {'include': args.include, 'exclude': args.exclude, 'path_filter': match}
+
+    if args.extents:
+        changed = ChangedExtents()
+        for path, cmd in stream.iter_decode(bogus=False):
+            changed.add(path, cmd)
+        extents = (
+            extent for extent in changed if match is None or match(extent['path'])
         )
-        return index + self.l_tlv + l_attr, float(sec) + nanos * 1e-9
+        if args.json or args.jsonl:
+            write_json(extents, out, pretty=args.pretty, lines=args.jsonl)
+        else:
+            print_extents(extents, args.csv, out)
+        return
 
-    def decode(self, bogus=True):
-        ''' Decodes commands + attributes from send stream
-        '''
-        offset = 17
-        cmd_ref = 0
-        # List of commands sequentially decoded
-        commands = []
-        # Modified paths: dict path => [cmd_ref1, cmd_ref2, ...]
-        paths = OrderedDict()
+    if args.summary:
+        summary = DirectorySummary(args.depth, match)
+        for path, cmd in stream.iter_decode(bogus=False, exclude=('utimes',)):
+            summary.add(path, cmd)
+        if args.json or args.jsonl:
+            write_json(summary, out, pretty=args.pretty, lines=args.jsonl)
+        else:
+            print_summary(summary, args.csv, out)
+        return
 
-        while True:
+    if args.with_data:
+        digests = WriteDigests()
+        for path, cmd in stream.iter_decode(bogus=False, data=True):
+            digests.add(path, cmd)
+        files = (file for file in digests if match is None or match(file['path']))
+        if args.json or args.jsonl:
+            write_json(files, out, pretty=args.pretty, lines=args.jsonl)
+        else:
+            print_data(files, args.csv, out)
+        return
 
-            # 3rd field is CRC, not used here
-            l_cmd, cmd, _ = unpack('<IHI', self.stream[offset : offset + self.l_head])
-            try:
-                command = self.send_cmds[cmd]
-            except IndexError:
-                raise ValueError(f'Unkown command {cmd}')
+    selected = (
+        cmd
+        for path, cmd in stream.iter_decode(bogus=args.bogus, **select)
+        if match is None or path is not None
+    )
 
-            cmd_short = command[13:].lower()
-            offset += self.l_head
+    if args.net:
+        changes = NetChanges()
+        for path, cmd in stream.iter_decode(bogus=False):
+            changes.add(path, cmd)
+        if match is not None:
+            changes = [
+                change
+                for change in changes
+                if match(change['path'])
+                or change['from'] is not None
+                and match(change['from'])
+            ]
+        if args.json or args.jsonl:
+            write_json(changes, out, pretty=args.pretty, lines=args.jsonl)
+        else:
+            print_net(changes, args.csv, out)
 
-            if command == 'BTRFS_SEND_C_RENAME':
-                offset2, path = self._tlv_get_string('BTRFS_SEND_A_PATH', offset)
-                offset2, path_to = self._tlv_get_string('BTRFS_SEND_A_PATH_TO', offset2)
-                if bogus:
-                    # Add bogus renamed_from command on destination to keep track
-                    # of what happened
-                    paths.setdefault(path_to, []).append(cmd_ref)
-                    commands.append(
-                        {'command': 'renamed_from', 'path': path, 'path_to': path_to}
-                    )
-                    cmd_ref += 1
-                paths.setdefault(path, []).append(cmd_ref)
-                commands.append(
-                    {'command': cmd_short, 'path': path, 'path_to': path_to}
-                )
+    elif args.by_inode:
+        # All commands are needed to follow names
+        inodes = InodeIndex()
+        commands, _ = stream.decode(
+            bogus=args.bogus, compact=args.compact, inodes=inodes
+        )
+        if args.json or args.jsonl:
+            write_json(
+                inode_objects(inodes, commands, match),
+                out,
+                pretty=args.pretty,
+                lines=args.jsonl,
+            )
+        else:
+            out.write(
+                f'Found a valid Btrfs stream header, version {stream.version}\n\n'
+            )
+            print_by_inodes(inodes, commands, args.csv, match, out)
 
-            elif command == 'BTRFS_SEND_C_SYMLINK':
-                offset2, path = self._tlv_get_string('BTRFS_SEND_A_PATH', offset)
-                offset2, ino = self._tlv_get_u64('BTRFS_SEND_A_INO', offset2)
-                offset2, path_link = self._tlv_get_string(
-                    'BTRFS_SEND_A_PATH_LINK', offset2
-                )
-                paths.setdefault(path, []).append(cmd_ref)
-                commands.append(
-                    {'command': cmd_short, 'path_link': path_link, 'inode': ino}
+    elif args.by_path or args.save:
+        if args.filter:
+            changes = NetChanges()
+            commands, paths = stream.decode(
+                bogus=args.bogus, compact=args.compact, changes=changes
+            )
+            if args.path:
+                paths = OrderedDict(
+                    (path, refs) for path, refs in paths.items() if match(path)
                 )
+            elif args.subtree is not None:
+                paths = paths.subtree(args.subtree)
+        elif args.max_memory:
+            changes = None
+            paths = SpilledPaths(args.max_memory << 20)
+            decoded = stream.iter_decode(bogus=args.bogus, **select)
+            for cmd_ref, (path, command) in enumerate(decoded):
+                if path is not None:
+                    paths.add(path, cmd_ref, command)
+            commands = paths.commands
+        else:
+            changes = None
+            commands, paths = stream.decode(
+                bogus=args.bogus, compact=args.compact, jobs=args.jobs, **select
+            )
+            if args.save:
+                write_archive(args.save, commands, paths, stream.version)
+        if args.by_path:
+            out.write(
+                f'Found a valid Btrfs stream header, version {stream.version}\n\n'
+            )
+            print_by_paths(paths, commands, changes, args.csv, out)
+        elif args.csv or args.json or args.jsonl:
+            # END is the only command without path left by path_filter
+            write_commands(
+                (cmd for cmd in commands if match is None or cmd['command'] != 'end'),
+                args,
+                out,
+            )
 
-            elif command == 'BTRFS_SEND_C_LINK':
-                offset2, path = self._tlv_get_string('BTRFS_SEND_A_PATH', offset)
-                offset2, path_link = self._tlv_get_string(
-                    'BTRFS_SEND_A_PATH_LINK', offset2
-                )
-                paths.setdefault(path, []).append(cmd_ref)
-                commands.append(
-                    {'command': cmd_short, 'path': path, 'path_link': path_link}
-                )
+    elif args.csv or args.json or args.jsonl:
+        # Commands are written as soon as they are decoded
+        write_commands(selected, args, out)
 
-            elif command == 'BTRFS_SEND_C_UTIMES':
-                offset2, path = self._tlv_get_string('BTRFS_SEND_A_PATH', offset)
-                offset2, atime = self._tlv_get_timespec('BTRFS_SEND_A_ATIME', offset2)
-                offset2, mtime = self._tlv_get_timespec('BTRFS_SEND_A_MTIME', offset2)
-                offset2, ctime = self._tlv_get_timespec('BTRFS_SEND_A_CTIME', offset2)
-                paths.setdefault(path, []).append(cmd_ref)
-                commands.append(
-                    {
-                        'command': cmd_short,
-                        'path': path,
-                        'atime': atime,
-                        'mtime': mtime,
-                        'ctime': ctime,
-                    }
-                )
+    elif args.verify:
+        # Only read commands (and check their CRC)
+        for _ in stream.iter_decode(bogus=False, include=()):
+            pass
+        out.write(f'Valid stream, {stream.length} bytes, CRC32C verified\n')
 
-            elif (
-                command
-                in 'BTRFS_SEND_C_MKFILE BTRFS_SEND_C_MKDIR BTRFS_SEND_C_UNLINK BTRFS_SEND_C_RMDIR'.split()
-            ):
-                offset2, path = self._tlv_get_string('BTRFS_SEND_A_PATH', offset)
-                paths.setdefault(path, []).append(cmd_ref)
-                commands.append({'command': cmd_short, 'path': path})
 
-            elif command in 'BTRFS_SEND_C_MKFIFO BTRFS_SEND_C_MKSOCK'.split():
-                offset2, path = self._tlv_get_string('BTRFS_SEND_A_PATH', offset)
-                offset2, ino = self._tlv_get_u64('BTRFS_SEND_A_INO', offset2)
-                offset2, rdev = self._tlv_get_u64('BTRFS_SEND_A_RDEV', offset2)
-                offset2, mode = self._tlv_get_u64('BTRFS_SEND_A_MODE', offset2)
-                paths.setdefault(path, []).append(cmd_ref)
-                commands.append(
-                    {'command': cmd_short, 'ino': ino, 'path': path, 'rdev': rdev}
-                )
+def write_commands(commands, args, out):
+    ''' Writes commands as CSV or JSON, as selected by command line args '''
+    if args.csv:
+        print_csv(commands, out)
+    else:
+        write_json(commands, out, pretty=args.pretty, lines=args.jsonl)
 
-            elif command == 'BTRFS_SEND_C_TRUNCATE':
-                offset2, path = self._tlv_get_string('BTRFS_SEND_A_PATH', offset)
-                offset2, size = self._tlv_get_u64('BTRFS_SEND_A_SIZE', offset2)
-                paths.setdefault(path, []).append(cmd_ref)
-                commands.append({'command': cmd_short, 'path': path, 'to_size': size})
-
-            elif command == 'BTRFS_SEND_C_SNAPSHOT':
-                offset2, path = self._tlv_get_string('BTRFS_SEND_A_PATH', offset)
-                offset2, uuid = self._tlv_get_uuid('BTRFS_SEND_A_UUID', offset2)
-                offset2, ctransid = self._tlv_get_u64('BTRFS_SEND_A_CTRANSID', offset2)
-                offset2, clone_uuid = self._tlv_get_uuid(
-                    'BTRFS_SEND_A_CLONE_UUID', offset2
-                )
-                offset2, clone_ctransid = self._tlv_get_u64(
-                    'BTRFS_SEND_A_CLONE_CTRANSID', offset2
-                )
-                paths.setdefault(path, []).append(cmd_ref)
-                commands.append(
-                    {
-                        'command': cmd_short,
-                        'path': path,
-                        'uuid': uuid,
-                        'ctransid': ctransid,
-                        'clone_uuid': clone_uuid,
-                        'clone_ctransid': clone_ctransid,
-                    }
-                )
 
-            elif command == 'BTRFS_SEND_C_SUBVOL':
-                offset2, path = self._tlv_get_string('BTRFS_SEND_A_PATH', offset)
-                offset2, uuid = self._tlv_get_uuid('BTRFS_SEND_A_UUID', offset2)
-                offset2, ctransid = self._tlv_get_u64('BTRFS_SEND_A_CTRANSID', offset2)
-                paths.setdefault(path, []).append(cmd_ref)
-                commands.append(
-                    {
-                        'command': cmd_short,
-                        'path': path,
-                        'uuid': uuid,
-                        'ctrans_id': ctransid,
-                    }
-                )
+def write_archive_report(archive, args, out):
+    ''' Writes the by path, CSV or JSON output selected by command line args
+    for a DiffArchive (--load) to out. Only paths selected by --subtree and
+    --path, and their commands, are read from the archive '''
+    match = path_matcher(args.subtree, args.path)
+    paths = archive.paths
+    if args.subtree is not None:
+        paths = paths.subtree(args.subtree)
+    if args.path:
+        paths = OrderedDict((path, refs) for path, refs in paths.items() if match(path))
 
-            elif command == 'BTRFS_SEND_C_MKNOD':
-                offset2, path = self._tlv_get_string('BTRFS_SEND_A_PATH', offset)
-                offset2, mode = self._tlv_get_u64('BTRFS_SEND_A_MODE', offset2)
-                offset2, rdev = self._tlv_get_u64('BTRFS_SEND_A_RDEV', offset2)
-                commands.append(
-                    {'command': cmd_short, 'path': path, 'mode': mode, 'rdev': rdev}
-                )
+    if args.by_path:
+        out.write(f'Found a valid Btrfs stream header, version {archive.version}\n\n')
+        print_by_paths(paths, archive, None, args.csv, out)
+    elif match is None:
+        write_commands(archive, args, out)
+    else:
+        cmd_refs = sorted(cmd_ref for _, refs in paths.items() for cmd_ref in refs)
+        write_commands((archive[cmd_ref] for cmd_ref in cmd_refs), args, out)
 
-            elif command == 'BTRFS_SEND_C_SET_XATTR':
-                offset2, path = self._tlv_get_string('BTRFS_SEND_A_PATH', offset)
-                offset2, xattr_name = self._tlv_get_string(
-                    'BTRFS_SEND_A_XATTR_NAME', offset2
-                )
-                offset2, xattr_data = self._tlv_get('BTRFS_SEND_A_XATTR_DATA', offset2)
-                paths.setdefault(path, []).append(cmd_ref)
-                commands.append(
-                    {
-                        'command': cmd_short,
-                        'path': path,
-                        'xattr_name': xattr_name,
-                        'xattr_data': xattr_data,
-                    }
-                )
 
-            elif command == 'BTRFS_SEND_C_REMOVE_XATTR':
-                offset2, path = self._tlv_get_string('BTRFS_SEND_A_PATH', offset)
-                offset2, xattr_name = self._tlv_get_string(
-                    'BTRFS_SEND_A_XATTR_NAME', offset2
-                )
-                paths.setdefault(path, []).append(cmd_ref)
-                commands.append(
-                    {'command': cmd_short, 'path': path, 'xattr_name': xattr_name}
-                )
+def open_cache(args):
+    ''' DiffCache selected by command line args, None with --no-cache, and
+    with --with-data unless --cache-data '''
+    if args.no_cache or args.with_data and not args.cache_data:
+        return None
+    try:
+        return DiffCache(args.cache_dir, args.cache_size << 20, args.btrfs)
+    except OSError as exc:
+        printerr(f'Warning: cache disabled, {exc}\n')
+        return None
 
-            elif command == 'BTRFS_SEND_C_WRITE':
-                offset2, path = self._tlv_get_string('BTRFS_SEND_A_PATH', offset)
-                offset2, file_offset = self._tlv_get_u64(
-                    'BTRFS_SEND_A_FILE_OFFSET', offset2
-                )
-                offset2, data = self._tlv_get('BTRFS_SEND_A_DATA', offset2)
-                paths.setdefault(path, []).append(cmd_ref)
-                commands.append(
-                    {
-                        'command': cmd_short,
-                        'path': path,
-                        'file_offset': file_offset,
-                        'data': data,
-                    }
-                )
 
-            elif command == 'BTRFS_SEND_C_CLONE':
-                offset2, path = self._tlv_get_string('BTRFS_SEND_A_PATH', offset)
-                offset2, file_offset = self._tlv_get_u64(
-                    'BTRFS_SEND_A_FILE_OFFSET', offset2
-                )
-                offset2, clone_len = self._tlv_get_u64(
-                    'BTRFS_SEND_A_CLONE_LEN', offset2
-                )
-                offset2, clone_uuid = self._tlv_get_uuid(
-                    'BTRFS_SEND_A_CLONE_UUID', offset2
-                )
-                offset2, clone_transid = self._tlv_get_u64(
-                    'BTRFS_SEND_A_CLONE_TRANSID', offset2
-                )
-                offset2, clone_path = self._tlv_get_string(
-                    'BTRFS_SEND_A_CLONE_PATH', offset
-                )  # BTRFS_SEND_A_CLONE8PATH
-                offset2, clone_offset = self._tlv_get_u64(
-                    'BTRFS_SEND_A_CLONE_OFFSET', offset2
-                )
-                paths.setdefault(path, []).append(cmd_ref)
-                commands.append(
-                    {
-                        'command': cmd_short,
-                        'path': path,
-                        'file_offset': file_offset,
-                        'clone_len': clone_len,
-                        'clone_uuid': clone_uuid,
-                        'clone_transid': clone_transid,
-                        'clone_path': clone_path,
-                        'clone_offset': clone_offset,
-                    }
-                )
+def diff_pair(pair, args):
+    ''' Diffs 2 snapshots, returns the output for the diff as a string,
+    None on error. Run in worker processes by print_chain(), each one
+    reading its own btrfs send pipe (or cached stream) '''
+    parent, child = pair
+    try:
+        diff = SnapshotDiff(
+            parent, child, open_cache(args), args.refresh, args.with_data, args.btrfs
+        )
+    except OSError:
+        printerr('Error: could not execute "btrfs send"\n')
+        return None
 
-            elif command == 'BTRFS_SEND_C_CHMOD':
-                offset2, path = self._tlv_get_string('BTRFS_SEND_A_PATH', offset)
-                offset2, mode = self._tlv_get_u64('BTRFS_SEND_A_MODE', offset2)
-                paths.setdefault(path, []).append(cmd_ref)
-                commands.append({'command': cmd_short, 'path': path, 'mode': mode})
+    out = StringIO()
+    start = time.perf_counter()
+    try:
+        stream = BtrfsStream(
+            diff.stream_file, stats=args.stats is not None, verify=args.verify
+        )
+        write_report(stream, args, out)
+    except (OSError, ValueError) as exc:
+        # Invalid stream (truncated, CRC error...)
+        diff.close(decoded=False)
+        printerr(f'Error: {parent} -> {child}: {exc}\n')
+        return None
+    except BaseException:
+        diff.close(decoded=False)
+        raise
+    if not diff.close():
+        return None
+    if args.stats is not None:
+        report_stats(
+            stream, diff, time.perf_counter() - start, args, f'{parent} -> {child}'
+        )
+    return out.getvalue()
 
-            elif command == 'BTRFS_SEND_C_CHOWN':
-                offset2, path = self._tlv_get_string('BTRFS_SEND_A_PATH', offset)
-                offset2, uid = self._tlv_get_u64('BTRFS_SEND_A_UID', offset2)
-                offset2, gid = self._tlv_get_u64('BTRFS_SEND_A_GID', offset2)
-                paths.setdefault(path, []).append(cmd_ref)
-                commands.append(
-                    {
-                        'command': cmd_short,
-                        'path': path,
-                        'user_id': uid,
-                        'group_id': gid,
-                    }
-                )
 
-            elif command == 'BTRFS_SEND_C_UPDATE_EXTENT':
-                offset2, path = self._tlv_get_string('BTRFS_SEND_A_PATH', offset)
-                offset2, file_offset = self._tlv_get_u64(
-                    'BTRFS_SEND_A_FILE_OFFSET', offset2
-                )
-                offset2, size = self._tlv_get_u64('BTRFS_SEND_A_SIZE', offset2)
-                paths.setdefault(path, []).append(cmd_ref)
-                commands.append(
-                    {
-                        'command': cmd_short,
-                        'path': path,
-                        'file_offset': file_offset,
-                        'size': size,
-                    }
-                )
+def pair_changes(pair, args):
+    ''' ChangeSet of the diff of 2 snapshots, None on error. Run in worker
+    processes by compose_report(), as diff_pair() '''
+    parent, child = pair
+    try:
+        diff = SnapshotDiff(
+            parent, child, open_cache(args), args.refresh, False, args.btrfs
+        )
+    except OSError:
+        printerr('Error: could not execute "btrfs send"\n')
+        return None
 
-            elif command == 'BTRFS_SEND_C_END':
-                commands.append(
-                    {
-                        'command': cmd_short,
-                        'headers_length': offset,
-                        'stream_length': len(self.stream),
-                    }
-                )
-                break
+    try:
+        stream = BtrfsStream(diff.stream_file, verify=args.verify)
+        changes = ChangeSet.from_stream(stream)
+    except (OSError, ValueError) as exc:
+        diff.close(decoded=False)
+        printerr(f'Error: {parent} -> {child}: {exc}\n')
+        return None
+    except BaseException:
+        diff.close(decoded=False)
+        raise
+    if not diff.close():
+        return None
+    return changes
+
+
+def read_changes(file_name, verify=False):
+    ''' ChangeSet of a send stream file, or of a change set saved as JSON
+    or NDJSON (--compose --json / --jsonl output) '''
+    with open(file_name, 'rb') as f_changes:
+        start = f_changes.read(1)
+        if start in (b'[', b'{'):
+            f_changes.seek(0)
+            if start == b'[':
+                return ChangeSet.from_records(json.load(f_changes))
+            return ChangeSet.from_records(json.loads(line) for line in f_changes)
+    with BtrfsStream(file_name, verify=verify) as stream:
+        return ChangeSet.from_stream(stream)
 
-            elif command == 'BTRFS_SEND_C_UNSPEC':
-                commands.append({'command': cmd_short})
 
+def compose_report(args, snapshots=None):
+    ''' Composes consecutive diffs, of snapshots (diffed in up to args.jobs
+    worker processes, reading cached streams if any) or of args.compose
+    files, and writes the net changes from the first to the last snapshot.
+    Returns False if a diff failed '''
+    if snapshots is None:
+        change_sets = []
+        for file_name in args.compose:
+            try:
+                change_sets.append(read_changes(file_name, args.verify))
+            except (OSError, ValueError) as exc:
+                printerr(f'Error: {file_name}: {exc}\n')
+                return False
+    else:
+        pairs = list(zip(snapshots, snapshots[1:]))
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            change_sets = list(executor.map(pair_changes, pairs, repeat(args)))
+        if any(changes is None for changes in change_sets):
+            return False
+
+    composed = change_sets[0]
+    for changes in change_sets[1:]:
+        composed = compose_changes(composed, changes)
+
+    match = path_matcher(args.subtree, args.path)
+    if match is not None:
+        composed = [
+            change
+            for change in composed
+            if match(change['path'])
+            or change['from'] is not None
+            and match(change['from'])
+        ]
+    with open_output() as out:
+        if args.json or args.jsonl:
+            write_json(composed, out, pretty=args.pretty, lines=args.jsonl)
+        else:
+            print_net(composed, args.csv, out)
+    return True
+
+
+def print_chain(snapshots, args):
+    ''' Diffs consecutive snapshots (snapshots[0] -> snapshots[1], ...) in
+    up to args.jobs worker processes, printing outputs in chain order as
+    soon as they are available. Returns False if a diff failed '''
+    pairs = list(zip(snapshots, snapshots[1:]))
+    as_json = args.json or args.jsonl
+    success = True
+    first = True
+
+    # Workers always return JSON lists, embedded in one object per diff
+    worker_args = argparse.Namespace(
+        **{**vars(args), 'json': as_json, 'jsonl': False, 'jobs': 1}
+    )
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor, open_output() as out:
+        results = executor.map(diff_pair, pairs, repeat(worker_args))
+        for (parent, child), result in zip(pairs, results):
+            if result is None:
+                success = False
+                continue
+            if as_json:
+                # One JSON object per diff, in a list unless --jsonl
+                diff = (
+                    f'{{"parent": {json.dumps(parent)}, '
+                    f'"child": {json.dumps(child)}, "diff": {result.strip()}}}'
+                )
+                if args.jsonl:
+                    out.write(f'{diff}\n')
+                else:
+                    out.write(f'{"[" if first else ", "}{diff}')
+                    first = False
             else:
-                # Shoud not happen!
-                raise ValueError(f'Unexpected command "{command}"')
+                title = f'{parent} -> {child}'
+                out.write(f'{title}\n{"=" * len(title)}\n{result}\n')
+            out.flush()
+        if as_json and not args.jsonl:
+            out.write('[]\n' if first else ']\n')
 
-            offset += l_cmd
-            cmd_ref += 1
+    return success
 
-        return commands, paths
 
+def diff_report(stream_file, args):
+    ''' Output selected by command line args for the stream file of a
+    diff, as a string. Run in worker processes by DiffDaemon '''
+    out = StringIO()
+    with BtrfsStream(stream_file, verify=args.verify) as stream:
+        write_report(stream, args, out)
+    return out.getvalue()
 
-def time_str(epoch):
-    ''' Epoch => string
-    1610391575.9802792 => '2021/01/11 08:59:35' '''
-    return time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(epoch))
 
+# inotify(7) events of names created, deleted or moved in a directory
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
 
-def print_by_paths(paths, commands, filter, csv):
 
-    # Temporary files / dirs / links... created by btrfs send: they are later
-    # renamed to definitive files / dirs / links...
-    if filter:
-        import re  # pylint: disable=import-outside-toplevel
+def inotify_watch(directory):
+    ''' Non-blocking inotify file descriptor, readable when names are
+    created, deleted or moved in directory; None if inotify is not
+    available (not Linux, no ctypes, limits reached...) '''
+    try:
+        import ctypes  # pylint: disable=import-outside-toplevel
 
-        re_tmp = re.compile(r'o\d+-\d+-0$')
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(O_NONBLOCK | O_CLOEXEC)
+    except (ImportError, OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+    if libc.inotify_add_watch(fd, fsencode(directory), mask) < 0:
+        close(fd)
+        return None
+    return fd
 
-    for path, actions in paths.items():
 
-        if filter and re_tmp.match(path):
-            # Don't display files created temporarily and later renamed
-            if not (
-                commands[actions[0]]['command'] in ('mkfile', 'mkdir', 'symlink')
-                and commands[actions[1]]['command'] == 'rename'
-            ) and not (
-                commands[actions[0]]['command'] == ('renamed_from')
-                and commands[actions[1]]['command'] == 'rmdir'
-            ):
-                print(f'{path}\n\t{actions} {"=" * 20}')
-            continue
+class DiffDaemon:
+    ''' Watches a directory of snapshots, diffs each new snapshot against
+    its predecessor (in name order, as --chain) as soon as it appears, and
+    serves outputs from an LRU of recent diffs on a UNIX socket
 
-        if path == '':
-            path = '__sub_root__'
+    The directory is watched with inotify, or polled every poll seconds.
+    btrfs send runs as asyncio subprocesses writing to the stream cache
+    (or a temporary file), streams are decoded in worker processes: at
+    most args.jobs diffs are computed at once, and a diff asked while it
+    is computed is awaited, not computed again.
+    A client sends a line with the name of a child snapshot (diffed
+    against its predecessor), parent and child names, or nothing for the
+    latest snapshot, and reads the output (or 'Error: ...') until EOF.
+    '''
 
-        prev_action = None
-        extents = []
-        print_actions = []
+    def __init__(self, directory, args, keep=64, poll=5.0):
+        self.directory = directory
+        self.args = args
+        # Workers decode sequentially, they already run in parallel
+        self.worker_args = argparse.Namespace(**{**vars(args), 'jobs': 1})
+        self.keep = keep
+        self.poll = poll
+        self.cache = open_cache(args)
+        # Snapshot names, sorted
+        self.snapshots = []
+        # (parent, child) => output, least recently used first
+        self.outputs = OrderedDict()
+        # (parent, child) => task computing the output
+        self.running = {}
+        self.executor = None
+        self.limit = None
 
-        for action in actions:
+    def scan(self, diff_new=True):
+        ''' Reads snapshot names, and starts diffs of new snapshots against
+        their predecessor '''
+        with scandir(self.directory) as entries:
+            names = sorted(
+                entry.name
+                for entry in entries
+                if entry.is_dir(follow_symlinks=False)
+                and not entry.name.startswith('.')
+            )
+        known = set(self.snapshots)
+        self.snapshots = names
+        if diff_new:
+            for parent, child in zip(names, names[1:]):
+                if child not in known:
+                    self.start(parent, child)
 
-            cmd = commands[action]
-            cmd_short = cmd['command']
+    def pair(self, names):
+        ''' (parent, child) of a request: [[parent] child] '''
+        snapshots = self.snapshots
+        for name in names:
+            if name not in snapshots:
+                raise ValueError(f'unknown snapshot "{name}"')
+        if len(names) == 2:
+            return tuple(names)
+        if len(names) > 2:
+            raise ValueError('expected [[PARENT] CHILD]')
+        index = snapshots.index(names[0]) if names else len(snapshots) - 1
+        if index < 1:
+            raise ValueError('no parent snapshot')
+        return snapshots[index - 1], snapshots[index]
 
-            if prev_action == 'update_extent' and cmd_short != 'update_extent':
-                print_actions.append(
-                    'update extents %d -> %d'
-                    % (extents[0][0], extents[-1][0] + extents[-1][1])
-                )
+    def start(self, parent, child):
+        ''' Task computing the output of parent -> child, started if needed '''
+        key = (parent, child)
+        task = self.running.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.compute(parent, child))
+            self.running[key] = task
 
-            if cmd_short == 'renamed_from':
-                if filter and re_tmp.match(cmd_short):
-                    if prev_action == 'unlink':
-                        del print_actions[-1]
-                        print_actions.append('rewritten')
-                    else:
-                        print_actions.append('created')
-                else:
-                    print_actions.append(f'renamed from "{cmd["path"]}"')
+            def done(task):
+                del self.running[key]
+                # Errors are reported by compute()
+                if not task.cancelled():
+                    task.exception()
 
-            elif cmd_short == 'set_xattr':
-                print_actions.append(f'xattr {cmd["xattr_name"]} {cmd["xattr_data"]}')
+            task.add_done_callback(done)
+        return task
 
-            elif cmd_short == 'update_extent':
-                extents.append((cmd['file_offset'], cmd['size']))
+    async def diff(self, parent, child):
+        ''' Output of parent -> child, from the LRU or computed '''
+        key = (parent, child)
+        output = self.outputs.get(key)
+        if output is not None:
+            self.outputs.move_to_end(key)
+            return output
+        # A client leaving does not cancel a diff other clients may wait for
+        return await asyncio.shield(self.start(parent, child))
 
-            elif cmd_short == 'truncate':
-                print_actions.append(f'truncate {cmd["to_size"]:d}')
+    async def compute(self, parent, child):
+        ''' Runs btrfs send unless the stream is cached, decodes it in a
+        worker process, and keeps the output in the LRU '''
+        loop = asyncio.get_running_loop()
+        parent_path = path_join(self.directory, parent)
+        child_path = path_join(self.directory, child)
+        async with self.limit:
+            start = time.perf_counter()
+            try:
+                key = None
+                if self.cache is not None:
+                    key = await loop.run_in_executor(
+                        None, self.cache.key, parent_path, child_path
+                    )
+                    if key is not None and self.args.with_data:
+                        key += '_data'
+                stream_file = None
+                if key is not None and not self.args.refresh:
+                    stream_file = self.cache.get(key)
+                f_stream = None
+                if stream_file is None:
+                    f_stream = await self.send(parent_path, child_path, key)
+                    stream_file = f_stream.name
+                try:
+                    output = await loop.run_in_executor(
+                        self.executor, diff_report, stream_file, self.worker_args
+                    )
+                except BaseException as exc:
+                    if f_stream is not None:
+                        unlink(f_stream.name)
+                    elif (
+                        key is not None
+                        and isinstance(exc, Exception)
+                        and not isinstance(exc, BrokenExecutor)
+                    ):
+                        # Corrupt cached stream, sent again next time
+                        try:
+                            unlink(stream_file)
+                        except OSError:
+                            pass
+                    raise
+            except Exception as exc:
+                printerr(f'Error: {parent} -> {child}: {exc}\n')
+                raise
+            if f_stream is not None:
+                if key is not None:
+                    self.cache.store(key, f_stream)
+                else:
+                    unlink(f_stream.name)
 
-            elif cmd_short == 'chown':
-                print_actions.append(f'owner {cmd["user_id"]}:{cmd["group_id"]}')
+        self.outputs[(parent, child)] = output
+        while len(self.outputs) > self.keep:
+            self.outputs.popitem(last=False)
+        printerr(
+            f'{parent} -> {child}: {time.perf_counter() - start:.2f}s'
+            f'{"" if f_stream is not None else " (cached)"}\n'
+        )
+        return output
+
+    async def send(self, parent_path, child_path, key):
+        ''' Runs btrfs send to a new file of the cache (if key is not None)
+        or a temporary file, returns the closed file.
+        Raises OSError if btrfs send failed '''
+        cmd = SnapshotDiff.command(
+            parent_path, child_path, self.args.with_data, self.args.btrfs
+        )
+        if key is not None:
+            f_stream = self.cache.create()
+        else:
+            f_stream = NamedTemporaryFile(suffix='.stream', delete=False)
+        with f_stream:
+            try:
+                send = await asyncio.create_subprocess_exec(*cmd, stdout=f_stream)
+                success = await send.wait() == 0
+            except BaseException:
+                unlink(f_stream.name)
+                raise
+        if not success:
+            unlink(f_stream.name)
+            raise OSError(f'CalledProcessError executing "{" ".join(cmd)}"')
+        return f_stream
 
-            elif cmd_short == 'chmod':
-                print_actions.append(f'mode {cmd["mode"]:o}')
+    async def serve(self, reader, writer):
+        ''' Answers the request of a client '''
+        try:
+            line = await reader.readline()
+            output = await self.diff(*self.pair(line.decode('utf8').split()))
+        except Exception as exc:
+            # Any failure is answered, e.g. struct.error on a corrupt stream
+            output = f'Error: {exc}\n'
+        try:
+            writer.write(output.encode('utf8', 'surrogateescape'))
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
 
-            elif cmd_short == 'link':
-                print_actions.append(f'link to "{cmd["path_link"]}"')
+    async def watch(self):
+        ''' Scans the directory when names change in it '''
+        fd = inotify_watch(self.directory)
+        if fd is None:
+            printerr(f'inotify not available, polling every {self.poll}s\n')
+            while True:
+                await asyncio.sleep(self.poll)
+                self.scan()
+            return
 
-            elif cmd_short == 'symlink':
-                print_actions.append(
-                    f'symlink to "{cmd["path_link"]}" (inode {cmd["inode"]})'
-                )
+        changed = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_reader(fd, changed.set)
+        try:
+            while True:
+                await changed.wait()
+                changed.clear()
+                # Events only tell to scan again
+                try:
+                    while read(fd, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                self.scan()
+        finally:
+            loop.remove_reader(fd)
+            close(fd)
 
-            elif cmd_short in ('unlink', 'mkfile', 'mkdir', 'mkfifo'):
-                print_actions.append(cmd_short)
+    async def run(self, socket_path):
+        ''' Serves diffs on socket_path, until cancelled '''
+        self.limit = asyncio.Semaphore(self.args.jobs)
+        self.executor = ProcessPoolExecutor(max_workers=self.args.jobs)
+        # Only the latest snapshot is diffed at start
+        self.scan(diff_new=False)
+        if len(self.snapshots) > 1:
+            self.start(*self.snapshots[-2:])
 
-            elif cmd_short == 'rename':
-                print_actions.append(f'rename to "{cmd["path_to"]}')
+        if stale_socket(socket_path):
+            # Left by a daemon which did not exit cleanly
+            unlink(socket_path)
+        server = await asyncio.start_unix_server(self.serve, path=socket_path)
+        asyncio.get_running_loop().add_signal_handler(
+            SIGTERM, asyncio.current_task().cancel
+        )
+        printerr(f'Watching {self.directory}, serving diffs on {socket_path}\n')
+        try:
+            async with server:
+                await self.watch()
+        finally:
+            unlink(socket_path)
+            self.executor.shutdown()
 
-            elif cmd_short == 'utimes':
-                if filter and prev_action == 'utimes':
-                    # Print only last utimes
-                    del print_actions[-1]
-                print_actions.append(
-                    f'times a={time_str(cmd["atime"])} '
-                    f'm={time_str(cmd["mtime"])} '
-                    f'c={time_str(cmd["ctime"])}'
-                )
 
-            elif cmd_short == 'snapshot':
-                print_actions.append(
-                    f'snapshot: uuid={cmd["uuid"]}, '
-                    f'ctransid={cmd["ctransid"]:d}, '
-                    f'clone_uuid={cmd["clone_uuid"]}, '
-                    f'clone_ctransid={cmd["clone_ctransid"]:d}'
-                )
+def stale_socket(path):
+    ''' True if path is a UNIX socket nobody listens to '''
+    try:
+        if not S_ISSOCK(lstat(path).st_mode):
+            return False
+    except OSError:
+        return False
+    with socket(AF_UNIX) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            return True
+    return False
 
-            elif cmd_short == 'write':
-                print_actions.append('write: from %d' % cmd[1])
-                print_actions.append(
-                    'data: \n' + ''.join([chr(c) for c in cmd[2]])
-                )  # convert bytes to string
 
-            else:
-                print_actions.append('%s, %s %s' % (action, cmd, '-' * 20))
-            prev_action = cmd_short
-
-            if csv:
-                sep = ';'
-                esc_sep = '\\' + sep
-                print(
-                    f'{path.replace(sep, esc_sep)}{sep}'
-                    f'{sep.join([a.replace(sep, esc_sep) for a in print_actions])}'
-                )
-            else:
-                print(f'\n{path}')
-                for print_action in print_actions:
-                    print(f'\t{print_action}')
+def default_socket():
+    ''' $XDG_RUNTIME_DIR/btrfs-snapshots-diff.sock, in the cache directory
+    if not set '''
+    base = environ.get('XDG_RUNTIME_DIR') or default_cache_dir()
+    return path_join(base, 'btrfs-snapshots-diff.sock')
 
 
 def main():
@@ -554,7 +3967,7 @@ def main():
     parser.add_argument(
         '-c', '--child', help='child snapshot (will be created if it does not exist)'
     )
-    parser.add_argument('-f', '--file', help="diff file")
+    parser.add_argument('-f', '--file', help="diff file, '-' for stdin")
     parser.add_argument(
         '-t',
         '--filter',
@@ -564,12 +3977,189 @@ def main():
     parser.add_argument(
         '-a', '--by_path', action='store_true', help='Group commands by path'
     )
+    parser.add_argument(
+        '--by-inode',
+        action='store_true',
+        help='Group commands by inode: all names of hard-linked files together',
+    )
+    parser.add_argument(
+        '-n',
+        '--net',
+        action='store_true',
+        help='Net changes: one line per created, deleted, modified or moved path',
+    )
+    parser.add_argument(
+        '--extents',
+        action='store_true',
+        help='Changed byte ranges per file, changed bytes per file and directory',
+    )
+    parser.add_argument(
+        '--summary',
+        action='store_true',
+        help='Counters of changes by directory (created, deleted, renamed, '
+        'modifications, changed bytes), computed in one pass with little memory',
+    )
+    parser.add_argument(
+        '--depth',
+        type=int,
+        default=1,
+        help='Depth of directories for --summary (default: 1)',
+    )
+    parser.add_argument(
+        '--with-data',
+        action='store_true',
+        help='Send file data, and display written bytes, ranges and hash per file',
+    )
     parser.add_argument('-s', '--csv', action='store_true', help='CSV output')
     parser.add_argument(
         '-j', '--json', action='store_true', help='JSON output (commands only)'
     )
     parser.add_argument(
-        '--pretty', action='store_true', help=argparse.SUPPRESS
+        '--jsonl',
+        action='store_true',
+        help='NDJSON output: one JSON command per line (commands only)',
+    )
+    parser.add_argument('--pretty', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument(
+        '--subtree', metavar='PATH', help='Only display changes on PATH and below it',
+    )
+    parser.add_argument(
+        '--path',
+        action='append',
+        metavar='GLOB',
+        help='Only display changes on paths matching GLOB (fnmatch pattern, '
+        'may be repeated)',
+    )
+    parser.add_argument(
+        '--include',
+        type=lambda names: names.split(','),
+        metavar='CMDS',
+        help='Only decode these commands, comma separated (e.g. mkfile,rename)',
+    )
+    parser.add_argument(
+        '--exclude',
+        type=lambda names: names.split(','),
+        metavar='CMDS',
+        help='Skip these commands, comma separated (e.g. utimes,chown)',
+    )
+    parser.add_argument(
+        '--compact',
+        action='store_true',
+        help='Keep decoded commands in compact arrays (less memory, slower access)',
+    )
+    parser.add_argument(
+        '--chain',
+        nargs='+',
+        metavar='SNAPSHOT',
+        help='diff consecutive snapshots (1st -> 2nd, 2nd -> 3rd...) in parallel; '
+        'a single quoted glob pattern is expanded and sorted',
+    )
+    parser.add_argument(
+        '--compose',
+        nargs='*',
+        metavar='STREAM',
+        help='Net changes from the first to the last snapshot of consecutive '
+        'diffs, composed without running btrfs send again, with changed extents '
+        'and last metadata: diffs of --chain snapshots, or STREAM files '
+        '(send streams, or --compose --json outputs)',
+    )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help='number of parallel jobs, for --chain and decoding large stream files '
+        '(default: 1)',
+    )
+    parser.add_argument(
+        '--cache-dir',
+        default=default_cache_dir(),
+        help='cache of send streams, by snapshots UUID and generation '
+        '(default: %(default)s)',
+    )
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=1024,
+        metavar='MB',
+        help='cache size, least recently used streams are deleted above '
+        '(default: %(default)s)',
+    )
+    parser.add_argument(
+        '--no-cache', action='store_true', help='do not read nor write the cache'
+    )
+    parser.add_argument(
+        '--refresh',
+        action='store_true',
+        help='run btrfs send even if the diff is cached, and update the cache',
+    )
+    parser.add_argument(
+        '--cache-data',
+        action='store_true',
+        help='also cache streams of --with-data (with file data)',
+    )
+    parser.add_argument(
+        '--btrfs',
+        default='btrfs',
+        metavar='PATH',
+        help='btrfs executable, e.g. a wrapper (default: btrfs in PATH)',
+    )
+    parser.add_argument(
+        '--watch',
+        metavar='DIR',
+        help='Daemon: diff each new snapshot of DIR against its predecessor as '
+        'soon as it appears, and serve outputs on a UNIX socket',
+    )
+    parser.add_argument(
+        '--socket',
+        metavar='PATH',
+        help='UNIX socket of --watch (default: '
+        '$XDG_RUNTIME_DIR/btrfs-snapshots-diff.sock)',
+    )
+    parser.add_argument(
+        '--keep',
+        type=int,
+        default=64,
+        metavar='N',
+        help='Number of recent diffs kept in memory by --watch (default: 64)',
+    )
+    parser.add_argument(
+        '--poll',
+        type=float,
+        default=5.0,
+        metavar='SECONDS',
+        help='Polling interval of --watch without inotify (default: 5)',
+    )
+    parser.add_argument(
+        '--verify',
+        action='store_true',
+        help='check the CRC32C of each command, stop at the first error; '
+        'alone, only verifies the stream',
+    )
+    parser.add_argument(
+        '--max-memory',
+        type=int,
+        metavar='MB',
+        help='With --by_path, spill commands sorted by path to temporary files '
+        'above MB of resident memory (only --by_path, not with --filter)',
+    )
+    parser.add_argument(
+        '--save',
+        metavar='ARCHIVE',
+        help='Save decoded commands and paths in a compact binary ARCHIVE',
+    )
+    parser.add_argument(
+        '--load',
+        metavar='ARCHIVE',
+        help='Read commands and paths from ARCHIVE (see --save) instead of '
+        'a stream, for --by_path, --csv and --json output',
+    )
+    parser.add_argument(
+        '--stats',
+        nargs='?',
+        const='text',
+        choices=('text', 'json'),
+        help='print phase timings, counts and bytes per command, largest paths '
+        'to stderr, as text (default) or JSON',
     )
     parser.add_argument(
         '-b',
@@ -581,27 +4171,186 @@ def main():
     #                        help="increase verbosity")
     args = parser.parse_args()
 
+    if not (
+        args.by_path
+        or args.by_inode
+        or args.net
+        or args.extents
+        or args.summary
+        or args.with_data
+        or args.csv
+        or args.json
+        or args.jsonl
+        or args.verify
+        or args.save
+        or args.compose is not None
+    ):
+        printerr('No output!\n')
+        parser.print_help()
+        return
+
+    modes = [
+        option
+        for option, used in (
+            ('--net', args.net),
+            ('--extents', args.extents),
+            ('--summary', args.summary),
+            ('--with-data', args.with_data),
+            ('--filter', args.filter),
+            ('--chain', args.chain),
+            ('--by-inode', args.by_inode),
+        )
+        if used
+    ]
+    if (args.save or args.load) and modes:
+        printerr(f'Error: --save / --load can\'t be used with {", ".join(modes)}\n')
+        exit(1)
+    if args.max_memory and (args.filter or args.save or args.load):
+        printerr('Error: --max-memory can\'t be used with --filter, --save, --load\n')
+        exit(1)
+    if args.max_memory and not args.by_path:
+        printerr('Error: --max-memory only applies to --by_path\n')
+        exit(1)
+    if args.max_memory and set(modes) - {'--chain'}:
+        printerr(
+            f'Error: --max-memory can\'t be used with '
+            f'{", ".join(mode for mode in modes if mode != "--chain")}\n'
+        )
+        exit(1)
+    if args.load and (args.include or args.exclude or args.verify or args.stats):
+        printerr(
+            'Error: --load can\'t be used with --include, --exclude, --verify, --stats\n'
+        )
+        exit(1)
+
+    if args.include is not None or args.exclude is not None:
+        if (
+            args.net
+            or args.extents
+            or args.summary
+            or args.with_data
+            or args.by_inode
+            or args.by_path
+            and args.filter
+        ):
+            printerr(
+                'Error: --include / --exclude only apply to commands output '
+                '(not with --net, --extents, --summary, --with-data, --by-inode '
+                'or --filter)\n'
+            )
+            exit(1)
+        try:
+            BtrfsStream.skipped_cmds(args.include, args.exclude)
+        except ValueError as exc:
+            printerr(f'Error: {exc}\n')
+            exit(1)
+
+    if args.watch:
+        modes = [
+            option
+            for option, used in (
+                ('--chain', args.chain),
+                ('--compose', args.compose is not None),
+                ('--parent', args.parent),
+                ('--file', args.file),
+                ('--load', args.load),
+                ('--save', args.save),
+                ('--max-memory', args.max_memory),
+                ('--stats', args.stats),
+            )
+            if used
+        ]
+        if modes:
+            printerr(f'Error: --watch can\'t be used with {", ".join(modes)}\n')
+            exit(1)
+        daemon = DiffDaemon(args.watch, args, args.keep, args.poll)
+        try:
+            asyncio.run(daemon.run(args.socket or default_socket()))
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+        except OSError as exc:
+            printerr(f'Error: {exc}\n')
+            exit(1)
+        return
+
+    if args.compose is not None:
+        modes = [
+            option
+            for option, used in (
+                ('--net', args.net),
+                ('--extents', args.extents),
+                ('--summary', args.summary),
+                ('--with-data', args.with_data),
+                ('--filter', args.filter),
+                ('--by_path', args.by_path),
+                ('--include', args.include),
+                ('--exclude', args.exclude),
+                ('--max-memory', args.max_memory),
+                ('--save', args.save),
+                ('--load', args.load),
+                ('--stats', args.stats),
+                ('--parent', args.parent),
+                ('--file', args.file),
+            )
+            if used
+        ]
+        if modes:
+            printerr(f'Error: --compose can\'t be used with {", ".join(modes)}\n')
+            exit(1)
+        if bool(args.compose) == bool(args.chain):
+            printerr('Error: --compose needs either stream files or --chain\n')
+            exit(1)
+        if args.compose and len(args.compose) < 2:
+            printerr('Error: compose needs at least 2 diffs!\n')
+            exit(1)
+        if args.compose:
+            if not compose_report(args):
+                exit(1)
+            return
+
+    if args.chain:
+        snapshots = args.chain
+        if len(snapshots) == 1 and glob.has_magic(snapshots[0]):
+            snapshots = sorted(glob.glob(snapshots[0]))
+        if len(snapshots) < 2:
+            printerr('Error: chain needs at least 2 snapshots!\n')
+            exit(1)
+        if args.compose is not None:
+            if not compose_report(args, snapshots):
+                exit(1)
+        elif not print_chain(snapshots, args):
+            exit(1)
+        return
+
+    if args.load:
+        try:
+            archive = DiffArchive(args.load)
+        except OSError as exc:
+            printerr(f'Error reading archive: {exc}\n')
+            exit(1)
+        except StreamError as exc:
+            printerr(f'{exc}\n')
+            exit(1)
+        with archive, open_output() as out:
+            write_archive_report(archive, args, out)
+        return
+
+    diff = None
     if args.parent:
         if args.child:
-            # TODO add option to ommit '--no-data'
-            stream_file = '/tmp/snaps-diff'
-            cmd = [
-                'btrfs',
-                'send',
-                '-p',
-                args.parent,
-                '--no-data',
-                '-f',
-                stream_file,
-                args.child,
-                '-q',
-            ]
             try:
-                subprocess.check_call(cmd)
-
-            except subprocess.CalledProcessError:
-                printerr('Error: CalledProcessError\nexecuting "{' '.join(cmd)}"\n')
+                diff = SnapshotDiff(
+                    args.parent,
+                    args.child,
+                    open_cache(args),
+                    args.refresh,
+                    args.with_data,
+                    args.btrfs,
+                )
+            except OSError:
+                printerr('Error: could not execute "btrfs send"\n')
                 exit(1)
+            stream_file = diff.stream_file
         else:
             printerr('Error: parent needs child!\n')
             parser.print_help()
@@ -612,41 +4361,45 @@ def main():
         exit(1)
 
     else:
+        # '-' reads the stream from stdin
         stream_file = args.file
 
-    stream = BtrfsStream(stream_file)
-    if stream.version is None:
+    start = time.perf_counter()
+    try:
+        stream = BtrfsStream(
+            stream_file, stats=args.stats is not None, verify=args.verify
+        )
+    except OSError as exc:
+        if diff is not None:
+            diff.close(decoded=False)
+        printerr(f'Error reading stream: {exc}\n')
+        exit(1)
+    except StreamError as exc:
+        if diff is not None:
+            diff.close(decoded=False)
+        printerr(f'{exc}\n')
         exit(1)
-    commands, paths = stream.decode(bogus=args.bogus)
 
-    if args.by_path:
-        print(f'Found a valid Btrfs stream header, version {stream.version}\n')
-        print_by_paths(paths, commands, args.filter, args.csv)
+    try:
+        with open_output() as out:
+            write_report(stream, args, out)
+    except ValueError as exc:
+        # Invalid stream (truncated, CRC error...)
+        if diff is not None:
+            diff.close(decoded=False)
+        printerr(f'Error: {exc}\n')
+        exit(1)
+    except BaseException:
+        # Don't cache a stream that could not be decoded
+        if diff is not None:
+            diff.close(decoded=False)
+        raise
 
-    elif args.csv:
-        sep = ';'
-        esc_sep = '\\' + sep
-        for cmd in commands:
-            print(f'{cmd["command"].replace(sep, esc_sep)}', end='')
-            for k in sorted(cmd):
-                if k == 'command':
-                    continue
-                v = cmd[k]
-                if isinstance(v, str):
-                    v = v.replace(sep, esc_sep)
-                print(f'{sep}{k}={v}', end='')
-            print()
-
-    elif args.json:
-        import json  # pylint: disable=import-outside-toplevel
-        if args.pretty:
-            print(json.dumps(commands, indent=2))
-        else:
-            print(json.dumps(commands))            
+    if diff is not None and not diff.close():
+        exit(1)
 
-    else:
-        printerr('No output!\n')
-        parser.print_help()
+    if args.stats is not None:
+        report_stats(stream, diff, time.perf_counter() - start, args)
 
 
 if __name__ == '__main__':
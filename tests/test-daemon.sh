@@ -0,0 +1,174 @@
+#!/bin/bash
+# Tests of --watch with tests/fake-btrfs and prepared streams, no Btrfs needed
+set -eu
+
+RED='\033[0;31m'
+GREEN='\033[0;32m'
+NC='\033[0m' # No Color
+
+cd "$(dirname "$0")/.."
+script=./btrfs-snapshots-diff.py
+tmp=$(mktemp -d)
+snaps=$tmp/snapshots
+socket=$tmp/diff.sock
+export FAKE_BTRFS_LOG=$tmp/sends.log
+daemon=
+trap 'stop; rm -rf "$tmp"' EXIT
+failed=0
+
+info(){
+    echo "INFO: $@"
+}
+
+fail(){
+    echo -e "${RED}ERROR: $@${NC}"
+    failed=1
+}
+
+start(){
+    $script --watch $snaps --socket $socket --btrfs tests/fake-btrfs \
+        --cache-dir $tmp/cache --poll 0.2 --jobs 2 --net 2> $tmp/daemon.log &
+    daemon=$!
+    for _ in $(seq 50); do
+        [ -S $socket ] && return
+        sleep 0.1
+    done
+    fail "daemon did not start"
+    cat $tmp/daemon.log
+    exit 1
+}
+
+stop(){
+    if [ -n "$daemon" ]; then
+        kill $daemon 2> /dev/null || true
+        wait $daemon 2> /dev/null || true
+        daemon=
+    fi
+}
+
+# request [[PARENT] CHILD]: prints the answer of the daemon, fails after 10s
+request(){
+    python3 - "$socket" "$@" <<'PYTHON'
+import socket
+import sys
+
+client = socket.socket(socket.AF_UNIX)
+client.settimeout(10)
+client.connect(sys.argv[1])
+client.sendall((' '.join(sys.argv[2:]) + '\n').encode())
+answer = b''
+while True:
+    data = client.recv(65536)
+    if not data:
+        break
+    answer += data
+sys.stdout.write(answer.decode())
+PYTHON
+}
+
+# check NAME ANSWER EXPECTED_FILE
+check(){
+    if [ "$2" = "$(cat $3)" ]; then
+        info "$1: OK"
+    else
+        fail "$1: unexpected answer"
+        echo "$2" | head -5
+    fi
+}
+
+# Snapshots s1 (first, no stream) to s3, and their expected net changes
+mkdir -p $snaps/s1 $snaps/s2 $snaps/s3
+./benchmark.py -n 2k --seed 1 --generate $snaps/s2/diff.stream > /dev/null
+./benchmark.py -n 2k --seed 2 --generate $snaps/s3/diff.stream > /dev/null
+for snap in s2 s3; do
+    $script -f $snaps/$snap/diff.stream --net > $tmp/$snap.expected
+done
+
+info "Starting daemon on $snaps"
+start
+check "latest diff" "$(request)" $tmp/s3.expected
+check "diff by child" "$(request s2)" $tmp/s2.expected
+check "diff by parent and child" "$(request s2 s3)" $tmp/s3.expected
+
+info "Adding snapshot s4"
+mkdir $tmp/s4
+./benchmark.py -n 2k --seed 4 --generate $tmp/s4/diff.stream > /dev/null
+$script -f $tmp/s4/diff.stream --net > $tmp/s4.expected
+> $FAKE_BTRFS_LOG
+mv $tmp/s4 $snaps/
+sleep 1
+# Concurrent requests, one btrfs send
+request s4 > $tmp/answer1 &
+client=$!
+request s4 > $tmp/answer2
+wait $client
+check "new snapshot" "$(cat $tmp/answer1)" $tmp/s4.expected
+check "concurrent request" "$(cat $tmp/answer2)" $tmp/s4.expected
+sends=$(grep -c s4 $FAKE_BTRFS_LOG || true)
+if [ "$sends" = 1 ]; then
+    info "one send for s4: OK"
+else
+    fail "$sends sends for s4"
+fi
+
+answer=$(request s0 || true)
+case "$answer" in
+"Error: unknown snapshot \"s0\"") info "unknown snapshot: OK" ;;
+*) fail "unknown snapshot: $answer" ;;
+esac
+
+info "Adding snapshot s5 with a corrupt stream"
+mkdir $tmp/s5
+python3 -c '
+import sys
+from struct import pack
+# truncate command whose size attribute has no value
+sys.stdout.buffer.write(
+    b"btrfs-stream\0" + pack("<I", 1) + pack("<IHI", 4, 17, 0) + pack("<HH", 4, 8)
+)' > $tmp/s5/diff.stream
+mv $tmp/s5 $snaps/
+sleep 1
+answer=$(request s5 || true)
+case "$answer" in
+Error:*) info "corrupt stream answered: OK" ;;
+*) fail "corrupt stream: $answer" ;;
+esac
+rm -r $snaps/s5
+
+info "Restarting daemon, with a corrupt cached stream s1 -> s2"
+stop
+uuid(){
+    echo "$snaps/$1" | md5sum | cut -c1-32
+}
+cached=$tmp/cache/$(uuid s1)-7_$(uuid s2)-7.stream
+if [ -f $cached ]; then
+    # Truncated
+    head -c 100 $snaps/s2/diff.stream > $cached
+else
+    fail "s1 -> s2 not cached"
+fi
+> $FAKE_BTRFS_LOG
+start
+answer=$(request s2 || true)
+case "$answer" in
+Error:*) info "corrupt cached stream answered: OK" ;;
+*) fail "corrupt cached stream: $answer" ;;
+esac
+check "corrupt cached stream sent again" "$(request s2)" $tmp/s2.expected
+if grep -q s2 $FAKE_BTRFS_LOG; then
+    info "cached stream dropped: OK"
+else
+    fail "cached stream not dropped"
+fi
+check "cached diff after restart" "$(request s3)" $tmp/s3.expected
+
+stop
+if [ -S $socket ]; then
+    fail "socket left after SIGTERM"
+fi
+
+if [ $failed = 0 ]; then
+    echo -e "${GREEN}PASSED: All tests passed succesfully.${NC}"
+else
+    exit 1
+fi
@@ -0,0 +1,199 @@
+#!/bin/bash
+# Tests on synthetic send streams (generated by benchmark.py), no Btrfs needed
+set -eu
+
+RED='\033[0;31m'
+GREEN='\033[0;32m'
+NC='\033[0m' # No Color
+
+cd "$(dirname "$0")/.."
+script=./btrfs-snapshots-diff.py
+tmp=$(mktemp -d)
+trap 'rm -rf "$tmp"' EXIT
+failed=0
+
+info(){
+    echo "INFO: $@"
+}
+
+fail(){
+    echo -e "${RED}ERROR: $@${NC}"
+    failed=1
+}
+
+# same NAME CMD1 CMD2: outputs of both commands must be identical
+same(){
+    if ! eval "$2" > $tmp/out1 || ! eval "$3" > $tmp/out2; then
+        fail "$1: command failed"
+    elif cmp -s $tmp/out1 $tmp/out2; then
+        info "$1: OK"
+    else
+        fail "$1: outputs differ"
+    fi
+}
+
+# expect NAME CMD: output of the command must be stdin
+expect(){
+    cat > $tmp/expected
+    if ! eval "$2" > $tmp/out1; then
+        fail "$1: command failed"
+    elif cmp -s $tmp/expected $tmp/out1; then
+        info "$1: OK"
+    else
+        fail "$1: unexpected output"
+        /usr/bin/diff $tmp/expected $tmp/out1 || true
+    fi
+}
+
+# Streams of a few commands, encoded with benchmark.py functions
+python3 - $tmp <<'PYTHON'
+import sys
+sys.path.insert(0, '.')
+from benchmark import *
+
+u64 = s_u64.pack
+C_RMDIR = 12
+
+
+def stream(name, *commands, version=1):
+    with open(f'{sys.argv[1]}/{name}.stream', 'wb') as f_out:
+        f_out.write(b'btrfs-stream\0' + version.to_bytes(4, 'little'))
+        f_out.writelines(commands)
+        f_out.write(command(C_END))
+
+
+def extent(path, offset, size):
+    return command(
+        C_UPDATE_EXTENT,
+        tlv(A_PATH, path),
+        tlv(A_FILE_OFFSET, u64(offset)),
+        tlv(A_SIZE, u64(size)),
+    )
+
+
+# Files below a renamed directory
+stream(
+    'rename-dir',
+    extent(b'a/f', 0, 4096),
+    command(C_RENAME, tlv(A_PATH, b'a'), tlv(A_PATH_TO, b'b')),
+    extent(b'b/f', 8192, 4096),
+)
+
+# Files below a deleted directory
+stream(
+    'delete-dir',
+    extent(b'a/b/f', 0, 4096),
+    extent(b'a/g', 0, 4096),
+    extent(b'c/f', 0, 4096),
+    command(C_RMDIR, tlv(A_PATH, b'a/b')),
+    command(C_UNLINK, tlv(A_PATH, b'a/g')),
+    command(C_RMDIR, tlv(A_PATH, b'a')),
+)
+
+# A hard-linked file
+stream(
+    'hardlink',
+    command(C_MKFILE, tlv(A_PATH, b'o257-7-0'), tlv(A_INO, u64(257))),
+    command(C_RENAME, tlv(A_PATH, b'o257-7-0'), tlv(A_PATH_TO, b'f')),
+    command(C_LINK, tlv(A_PATH, b'g'), tlv(A_PATH_LINK, b'f')),
+    extent(b'g', 0, 4096),
+)
+
+# Written and encoded data
+stream(
+    'encoded',
+    command(
+        C_WRITE,
+        tlv(A_PATH, b'f'),
+        tlv(A_FILE_OFFSET, u64(0)),
+        data_tlv(bytes(4096), 2),
+    ),
+    command(
+        C_ENCODED_WRITE,
+        tlv(A_PATH, b'f'),
+        tlv(A_FILE_OFFSET, u64(8192)),
+        tlv(A_UNENCODED_FILE_LEN, u64(16384)),
+        tlv(A_UNENCODED_LEN, u64(16384)),
+        tlv(A_UNENCODED_OFFSET, u64(0)),
+        tlv(A_COMPRESSION, (2).to_bytes(4, 'little')),
+        data_tlv(bytes(100), 2),
+    ),
+    version=2,
+)
+
+# v2 data of 0 and 1 byte, ending its command
+stream(
+    'small-writes',
+    *(
+        command(
+            C_WRITE,
+            tlv(A_PATH, b'f'),
+            tlv(A_FILE_OFFSET, u64(size)),
+            data_tlv(bytes(size), 2),
+        )
+        for size in (0, 1)
+    ),
+    version=2,
+)
+PYTHON
+
+expect "--extents of a renamed directory" \
+    "$script -f $tmp/rename-dir.stream --extents" <<'EOF'
+b/f	8192 bytes changed: 0-4096 8192-12288
+b/	8192 bytes changed in 1 files
+__sub_root__/	8192 bytes changed in 1 files
+EOF
+
+expect "--extents of a deleted directory" \
+    "$script -f $tmp/delete-dir.stream --extents" <<'EOF'
+c/f	4096 bytes changed: 0-4096
+c/	4096 bytes changed in 1 files
+__sub_root__/	4096 bytes changed in 1 files
+EOF
+
+expect "--by-inode" "$script -f $tmp/hardlink.stream --by-inode" <<'EOF'
+Found a valid Btrfs stream header, version 1
+
+
+inode 257 generation 7: f, g
+	o257-7-0: mkfile
+	o257-7-0: rename to "f
+	g: link to "f"
+	g: update extents 0 -> 4096
+EOF
+
+expect "--by-inode --jsonl" "$script -f $tmp/hardlink.stream --by-inode --jsonl" <<'EOF'
+{"inode": 257, "generation": 7, "names": ["f", "g"], "commands": [{"command": "mkfile", "path": "o257-7-0"}, {"command": "rename", "path": "o257-7-0", "path_to": "f"}, {"command": "link", "path": "g", "path_link": "f"}, {"command": "update_extent", "path": "g", "file_offset": 0, "size": 4096}]}
+EOF
+
+expect "--with-data of encoded writes" \
+    "$script -f $tmp/encoded.stream --with-data | sed -r 's/[0-9a-f]{64}/HASH/'" <<'EOF'
+f	20480 bytes written, 20480 distinct in 2 ranges, sha256 HASH
+EOF
+
+same "v2 writes of 0 and 1 byte from a pipe" \
+    "$script -f $tmp/small-writes.stream -a" \
+    "cat $tmp/small-writes.stream | $script -f - -a"
+
+info "Generating streams in $tmp"
+./benchmark.py -n 20k --mix write=1 --generate $tmp/v1.stream > /dev/null
+./benchmark.py -n 20k --proto 2 --mix write=1,encoded_write=1,fallocate=1 \
+    --generate $tmp/v2.stream > /dev/null
+
+for version in v1 v2; do
+    stream=$tmp/$version.stream
+    expect "$version --verify" \
+        "$script -f $stream --verify | sed -r 's/[0-9]+ bytes/N bytes/'" <<'EOF'
+Valid stream, N bytes, CRC32C verified
+EOF
+    same "$version --max-memory" "$script -f $stream -a" \
+        "$script -f $stream -a --max-memory 1"
+    same "$version --max-memory from a pipe" "$script -f $stream -a" \
+        "cat $stream | $script -f - -a --max-memory 1"
+done
+
+if [ $failed = 0 ]; then
+    echo -e "${GREEN}PASSED: All tests passed succesfully.${NC}"
+else
+    exit 1
+fi